@@ -1,4 +1,10 @@
-from sqlmodel import Session, create_engine
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlmodel import Session, SQLModel, create_engine
 
 from src.util.env import get_settings
 
@@ -6,11 +12,103 @@ settings = get_settings()
 
 DATABASE_URL = f"sqlite:///{settings.DB_FILE}"
 
-engine = create_engine(DATABASE_URL)
+# A run holds one long-lived session and each concurrent AI request one for its
+# tools, keep those warm and leave overflow for the response cache's short ones
+engine = create_engine(
+    DATABASE_URL,
+    poolclass=QueuePool,
+    pool_size=settings.AI_CONCURRENCY + 1,
+    max_overflow=4,
+    connect_args={"check_same_thread": False, "timeout": 30},
+)
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # pysqlite emits BEGIN lazily and commits on its own before a SAVEPOINT, leave
+    # transaction control to SQLAlchemy so savepoints nest in a real transaction
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    try:
+        # WAL lets readers proceed while a write is in flight and only needs
+        # a single fsync per commit when combined with synchronous=NORMAL
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.execute("PRAGMA foreign_keys=ON")
+    finally:
+        cursor.close()
+
+
+@event.listens_for(engine, "begin")
+def _begin_transaction(conn):
+    # A deferred transaction that reads before it writes gets SQLITE_BUSY straight
+    # away when another writer got in first, writers take the lock up front so
+    # they wait out the busy timeout instead
+    if conn.get_execution_options().get("begin_immediate"):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    else:
+        conn.exec_driver_sql("BEGIN")
+
+
+# Shared factory so callers can open one session and reuse it across several
+# model calls; objects stay usable after commit since attributes aren't expired
+SessionLocal = sessionmaker(bind=engine, class_=Session, expire_on_commit=False)
+
+
+def create_db():
+    SQLModel.metadata.create_all(engine)
+    # create_all skips tables that already exist, so add indexes introduced since
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    # Superseded by response_cache, whose keys include the model and prompt version
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE IF EXISTS ai_cache")
+
+
+@contextmanager
+def read_session(session: Session | None = None) -> Iterator[Session]:
+    """
+    Provide a session for read-only queries.
+    Reuses the caller's session when one is given, otherwise a pooled session is
+    opened for the block and closed afterwards.
+    :param session: An optional session to reuse.
+    :return: The session to query with.
+    """
+    if session is not None:
+        yield session
+        return
+    with SessionLocal() as new_session:
+        yield new_session
+
+
+@contextmanager
+def write_session(session: Session | None = None) -> Iterator[Session]:
+    """
+    Provide a session for writes.
+    Reuses the caller's session when one is given, the changes are flushed and left
+    for the caller to commit. Otherwise a pooled session is opened for the block,
+    committed, or rolled back on error, and closed afterwards. A transaction
+    started here takes the write lock immediately.
+    :param session: An optional session to reuse.
+    :return: The session to write with.
+    """
+    if session is not None:
+        if not session.in_transaction():
+            session.connection(execution_options={"begin_immediate": True})
+        yield session
+        session.flush()
+        return
+    with SessionLocal.begin() as new_session:
+        new_session.connection(execution_options={"begin_immediate": True})
+        yield new_session
 
 
 def get_db():
-    db = Session(engine)
+    db = SessionLocal()
     try:
         yield db
     finally:
@@ -3,6 +3,7 @@ from caldav import Calendar, DAVClient
 from caldav.davclient import get_davclient
 from pydantic import AnyUrl
 
+from src.db import Session
 from src.model.event import Event
 from src.util.logging import logger
 
@@ -35,8 +36,32 @@ def _find_caldav_event_by_id(calendar: Calendar, caldav_id: str):
 
 
 def add_to_caldav(
-    url: AnyUrl, username: str, password: str, calendar_name: str, events: list[Event]
+    url: AnyUrl,
+    username: str,
+    password: str,
+    calendar_name: str,
+    events: list[Event],
+    session: Session | None = None,
 ):
+    events = [event for event in events if not event.in_calendar]
+    try:
+        push_to_caldav(url, username, password, calendar_name, events)
+    finally:
+        # Record every event that reached the calendar, even if a later one failed
+        for event in events:
+            if event.in_calendar:
+                event.save_to_caldav(session)
+
+
+def push_to_caldav(
+    url: AnyUrl,
+    username: str,
+    password: str,
+    calendar_name: str,
+    events: list[Event],
+):
+    # Network only, written events are marked in_calendar with their CalDAV id and
+    # the caller persists them
     with authenticate_caldav(url, username, password) as client:
         principal = client.principal()
         ## The principals calendars can be fetched like this:
@@ -44,7 +69,7 @@ def add_to_caldav(
 
         calendar: Calendar = next(cal for cal in calendars if cal.name == calendar_name)
         if not calendar:
-            logger.error(f"Calendar '{calendar_name}' not found.")
+            logger.error("Calendar '%s' not found.", calendar_name)
             raise ValueError(f"Calendar '{calendar_name}' not found.")
 
         events = [event for event in events if not event.in_calendar]
@@ -58,7 +83,9 @@ def add_to_caldav(
                     cal_event = _find_caldav_event_by_id(calendar, str(event.caldav_id))
                     if cal_event:
                         logger.info(
-                            f"Updating event {event.summary} in CalDAV calendar '{calendar_name}'"
+                            "Updating event %s in CalDAV calendar '%s'",
+                            event.summary,
+                            calendar_name,
                         )
                         # If all-day, convert to date objects expected by vobject
                         if event.all_day:
@@ -85,7 +112,7 @@ def add_to_caldav(
                                 cal_event.delete()
                             except Exception as e:
                                 logger.error(
-                                    f"Failed to delete existing CalDAV event: {e}"
+                                    "Failed to delete existing CalDAV event: %s", e
                                 )
                                 raise
                             new_cal_event = calendar.add_event(
@@ -94,23 +121,25 @@ def add_to_caldav(
                                 summary=event.summary,
                             )
                             event.caldav_id = getattr(new_cal_event, "id", None)
-                            event.save_to_caldav()
+                            event.in_calendar = True
                             continue
 
                         # update local model and mark saved to caldav
-                        event.save_to_caldav()
+                        event.in_calendar = True
                         continue  # processed this event
                     # if cal_event not found, fall through to add a new one
                 except Exception as e:
                     logger.error(
-                        f"Failed to update event {event.summary} in CalDAV: {e}"
+                        "Failed to update event %s in CalDAV: %s", event.summary, e
                     )
                     raise
 
             # Default: add new event
             try:
                 logger.info(
-                    f"Adding event {event.summary} to CalDAV calendar '{calendar_name}'"
+                    "Adding event %s to CalDAV calendar '%s'",
+                    event.summary,
+                    calendar_name,
                 )
                 if event.all_day:
                     event.start = event.start.date()
@@ -119,9 +148,9 @@ def add_to_caldav(
                     dtstart=event.start, dtend=event.end, summary=event.summary
                 )
                 event.caldav_id = getattr(cal_event, "id", None)
-                event.save_to_caldav()
+                event.in_calendar = True
             except Exception as e:
-                logger.error(f"Failed to add event {event.summary} to CalDAV: {e}")
+                logger.error("Failed to add event %s to CalDAV: %s", event.summary, e)
                 raise
 
 
@@ -137,25 +166,28 @@ def delete_from_caldav(
                 cal for cal in calendars if cal.name == calendar_name
             )
             if not calendar:
-                logger.error(f"Calendar '{calendar_name}' not found.")
+                logger.error("Calendar '%s' not found.", calendar_name)
                 raise ValueError(f"Calendar '{calendar_name}' not found.")
 
             cal_event = _find_caldav_event_by_id(calendar, event.caldav_id)
             if not cal_event:
-                logger.warning(f"Event with caldav_id '{event.caldav_id}' not found.")
+                logger.warning("Event with caldav_id '%s' not found.", event.caldav_id)
                 raise ValueError(f"Event with caldav_id '{event.caldav_id}' not found.")
 
             try:
                 logger.info(
-                    f"Deleting event with caldav_id '{event.caldav_id}' from CalDAV calendar '{calendar_name}'"
+                    "Deleting event with caldav_id '%s' from CalDAV calendar '%s'",
+                    event.caldav_id,
+                    calendar_name,
                 )
                 cal_event.delete()
             except Exception as e:
                 logger.error(
-                    f"Failed to delete event with caldav_id '{event.caldav_id}': {e}"
+                    "Failed to delete event with caldav_id '%s': %s", event.caldav_id, e
                 )
                 raise
     else:
         logger.warning(
-            f"Event id '{event.id}' is not in CalDAV or has no caldav_id; skipping deletion."
+            "Event id '%s' is not in CalDAV or has no caldav_id; skipping deletion.",
+            event.id,
         )
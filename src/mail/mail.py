@@ -1,13 +1,21 @@
 import email
 import imaplib
+import ssl
 from datetime import datetime
 from email.policy import default
 from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from itertools import batched
 
-from src.model.email import EMail
+from src.model.email import EMail, EMailType
 from src.util.env import Settings
 from util.logging import logger
 
+FETCH_BATCH_SIZE = 100
+
+# Building a context loads the system CA bundle, so share one per process
+SSL_CONTEXT = ssl.create_default_context()
+
 
 def authenticate(settings: Settings) -> imaplib.IMAP4 | imaplib.IMAP4_SSL:
     """
@@ -35,27 +43,25 @@ def get_emails_by_filter(
     settings: Settings,
     since: datetime | None = None,
 ):
-    search_str: str = ""
-    if settings.FILTER_FROM_EMAIL:
-        search_str += f'FROM "{settings.FILTER_FROM_EMAIL}" '
-    if settings.FILTER_SUBJECT:
-        search_str += f'SUBJECT "{settings.FILTER_SUBJECT}" '
+    search_str = __base_search_criteria(
+        settings.FILTER_FROM_EMAIL, settings.FILTER_SUBJECT
+    )
     if since:
-        search_str += f"SINCE {since.strftime('%d-%b-%Y')} "
+        search_str = f"{search_str} SINCE {since.strftime('%d-%b-%Y')}".strip()
     if not search_str:
         logger.error("At least one filter (from_email or subject) must be provided")
         raise ValueError("At least one filter (from_email or subject) must be provided")
 
     status, _ = client.select(settings.IMAP_MAILBOX)
     if status != "OK":
-        logger.error(f"Failed to select mailbox '{settings.IMAP_MAILBOX}': {status}")
+        logger.error("Failed to select mailbox '%s': %s", settings.IMAP_MAILBOX, status)
         raise ConnectionError(
             f"Failed to select mailbox '{settings.IMAP_MAILBOX}': {status}"
         )
 
-    status, data = client.search(None, search_str.strip())
+    status, data = client.search(None, search_str)
     if status != "OK":
-        logger.error(f"Failed to search emails: {data}")
+        logger.error("Failed to search emails: %s", data)
         raise ValueError(f"Failed to search emails: {data}")
 
     email_ids: list[str] = data[0].split()
@@ -64,42 +70,58 @@ def get_emails_by_filter(
 
     emails: list[EMail] = []
 
-    for email_id in reversed(email_ids):
-        raw = __get_email(client, email_id)
-
-        msg = email.message_from_bytes(raw, policy=default)
-        email_type, body = __pick_best_text(msg)
-        emails.append(
-            EMail(
-                id=int(email_id.decode()),
-                subject=msg.get("subject", ""),
-                from_address=msg.get("from", ""),
-                delivery_date=parsedate_to_datetime(msg.get("date")),
-                body=body or "(No printable text body)",
-                email_type=email_type.upper() or "PLAIN",
+    # One FETCH per batch of ids instead of one round trip per message
+    for batch in batched(reversed(email_ids), FETCH_BATCH_SIZE):
+        raw_by_id = __fetch_batch(client, batch)
+        for email_id in batch:
+            raw = raw_by_id.get(email_id)
+            if raw is None:
+                logger.debug(
+                    "Email %s missing from batch fetch, fetching alone", email_id
+                )
+                raw = __get_email(client, email_id)
+
+            msg = email.message_from_bytes(raw, policy=default)
+            email_type, body = __pick_best_text(msg)
+            emails.append(
+                EMail(
+                    id=int(email_id.decode()),
+                    subject=msg.get("subject", ""),
+                    from_address=msg.get("from", ""),
+                    delivery_date=parsedate_to_datetime(msg.get("date")),
+                    body=body or "(No printable text body)",
+                    email_type=EMailType(email_type or "plain"),
+                )
             )
-        )
-        emails.sort(key=lambda e: e.delivery_date)
+    emails.sort(key=lambda e: e.delivery_date)
     return emails
 
 
+@lru_cache(maxsize=8)
+def __base_search_criteria(from_email: str | None, subject: str | None) -> str:
+    criteria: list[str] = []
+    if from_email:
+        criteria.append(f'FROM "{from_email}"')
+    if subject:
+        criteria.append(f'SUBJECT "{subject}"')
+    return " ".join(criteria)
+
+
 def __connect_imap_ssl(host: str, port: int, user: str, password: str):
     try:
-        client = imaplib.IMAP4_SSL(host, port)
+        client = imaplib.IMAP4_SSL(host, port, ssl_context=SSL_CONTEXT)
         client.login(user, password)
         return client
     except imaplib.IMAP4.error as e:
-        logger.error(f"IMAP authentication failed: {e}")
+        logger.error("IMAP authentication failed: %s", e)
         raise ConnectionError(f"IMAP authentication/connection failed: {e}")
 
 
 def __connect_imap_starttls(host: str, port: int, user: str, password: str):
-    import ssl
-
     try:
         client = imaplib.IMAP4(host, port)
     except imaplib.IMAP4.error as e:
-        logger.error(f"IMAP connection failed: {e}")
+        logger.error("IMAP connection failed: %s", e)
         raise ConnectionError(f"IMAP connection (plain) failed: {e}")
 
     # Get capabilities before STARTTLS
@@ -115,11 +137,10 @@ def __connect_imap_starttls(host: str, port: int, user: str, password: str):
         logger.error("Server does not advertise STARTTLS capability")
         raise ConnectionError("Server does not advertise STARTTLS capability")
 
-    context = ssl.create_default_context()
     try:
-        client.starttls(context)
+        client.starttls(SSL_CONTEXT)
     except (imaplib.IMAP4.error, ssl.SSLError) as e:
-        logger.error(f"STARTTLS negotiation failed: {e}")
+        logger.error("STARTTLS negotiation failed: %s", e)
         raise ConnectionError(f"STARTTLS negotiation failed: {e}")
 
     # (Re)fetch capabilities after STARTTLS if needed (some servers change them)
@@ -134,25 +155,12 @@ def __connect_imap_starttls(host: str, port: int, user: str, password: str):
 
 
 def __pick_best_text(part_msg: email.message.EmailMessage) -> tuple[str | None, str]:
-    email_type = None
-    if part_msg.is_multipart():
-        plain = None
-        html = None
-        for part in part_msg.iter_parts():
-            ctype = part.get_content_type()
-            if ctype == "text/plain" and plain is None:
-                plain = part.get_content()
-                email_type = "plain"
-            elif ctype == "text/html" and html is None:
-                html = part.get_content()
-                email_type = "plain"
-        return email_type, (plain or html)
-    else:
-        if part_msg.get_content_type() in ("text/plain", "text/html"):
-            email_type = part_msg.get_content_type().replace("text/", "")
-            content = part_msg.get_content()
-            return email_type, content
-    return email_type, ""
+    # get_body walks the MIME tree once, skips attachments and stops at the first
+    # text/plain part, only falling back to text/html when there is none
+    part = part_msg.get_body(preferencelist=("plain", "html"))
+    if part is None:
+        return None, ""
+    return part.get_content_subtype(), part.get_content()
 
 
 def __get_email(client: imaplib.IMAP4 | imaplib.IMAP4_SSL, email_id: str) -> bytes:
@@ -161,11 +169,29 @@ def __get_email(client: imaplib.IMAP4 | imaplib.IMAP4_SSL, email_id: str) -> byt
         logger.debug("Fetching full email failed, trying BODY[]")
         raw = __fetch_first_bytes(client, email_id, "(BODY[])")
     if raw is None:
-        logger.error(f"Failed to fetch email with ID {email_id}")
+        logger.error("Failed to fetch email with ID %s", email_id)
         raise ValueError(f"Failed to fetch email with ID {email_id}")
     return raw
 
 
+def __fetch_batch(
+    client: imaplib.IMAP4 | imaplib.IMAP4_SSL, email_ids: tuple[bytes, ...]
+) -> dict[bytes, bytes]:
+    status, msg_data = client.fetch(b",".join(email_ids), "(RFC822)")
+    if status != "OK" or not msg_data:
+        return {}
+    raw_by_id: dict[bytes, bytes] = {}
+    for part in msg_data:
+        # Each message comes back as (b"<id> (RFC822 {<size>}", <raw bytes>)
+        if (
+            isinstance(part, tuple)
+            and len(part) > 1
+            and isinstance(part[1], (bytes, bytearray))
+        ):
+            raw_by_id[part[0].split(None, 1)[0]] = part[1]
+    return raw_by_id
+
+
 def __fetch_first_bytes(client, email_id: str, spec: str) -> bytes | None:
     status, msg_data = client.fetch(email_id, spec)
     if status != "OK" or not msg_data:
@@ -1,12 +1,105 @@
 import email
 import re
+import threading
 import time
 from email import policy
 
 from imapclient import IMAPClient
 
+from src.mail.mail import SSL_CONTEXT
+from src.util.env import Settings
 from util.logging import logger
 
+# RFC 2177 asks clients to re-issue IDLE before the server's 30 minute timeout
+IDLE_REFRESH_SECONDS = 29 * 60
+# How often a wait checks whether it should stop, e.g. on shutdown
+IDLE_STOP_CHECK_SECONDS = 1
+
+
+def start_idle(settings: Settings) -> IMAPClient:
+    """
+    Connect to the mailbox and put the connection in IDLE.
+    The server reports every message arriving from now on, so call this before
+    searching the mailbox and then wait with `wait_for_new_mail`.
+    :param settings: The settings holding the IMAP connection details.
+    :return: The client, in IDLE.
+    :raises ConnectionError: If the server does not support IDLE.
+    """
+    client = IMAPClient(
+        settings.IMAP_HOST,
+        settings.IMAP_PORT,
+        use_uid=True,
+        ssl=settings.IMAP_SSL,
+        ssl_context=SSL_CONTEXT,
+    )
+    try:
+        if not settings.IMAP_SSL:
+            client.starttls(SSL_CONTEXT)
+        client.login(settings.IMAP_USERNAME, settings.IMAP_PASSWORD)
+        if not client.has_capability("IDLE"):
+            raise ConnectionError("Server does not advertise IDLE capability")
+        client.select_folder(settings.IMAP_MAILBOX, readonly=True)
+        client.idle()
+    except Exception:
+        client.shutdown()
+        raise
+    return client
+
+
+def wait_for_new_mail(
+    client: IMAPClient, timeout: float, stop: threading.Event
+) -> bool:
+    """
+    Block until the server reports a new message in the mailbox, the timeout expires or
+    `stop` is set. Mail that arrived since `start_idle` is reported straight away.
+    The connection is closed before returning.
+    :param client: The client returned by `start_idle`.
+    :param timeout: The maximum number of seconds to wait.
+    :param stop: Ends the wait early once set, it is checked every second.
+    :return: True if new mail arrived, False if the timeout expired or the wait stopped.
+    """
+    deadline = time.monotonic() + timeout
+    idling = True
+    try:
+        while True:
+            # Ending IDLE hands back everything reported so far, re-issuing it also
+            # resets the server's inactivity timeout
+            _, responses = client.idle_done()
+            idling = False
+            if __reports_new_mail(responses):
+                return True
+            remaining = deadline - time.monotonic()
+            if stop.is_set() or remaining <= 0:
+                return False
+
+            client.idle()
+            idling = True
+            refresh_at = time.monotonic() + min(remaining, IDLE_REFRESH_SECONDS)
+            while not stop.is_set() and (wait := refresh_at - time.monotonic()) > 0:
+                responses = client.idle_check(
+                    timeout=min(wait, IDLE_STOP_CHECK_SECONDS)
+                )
+                if __reports_new_mail(responses):
+                    return True
+    finally:
+        try:
+            if idling:
+                client.idle_done()
+            client.logout()
+        except Exception as e:  # noqa: BLE001
+            logger.debug("Failed to close the IMAP IDLE connection: %s", e)
+            client.shutdown()
+
+
+def __reports_new_mail(responses: list) -> bool:
+    if any(
+        isinstance(resp, tuple) and len(resp) > 1 and resp[1] == b"EXISTS"
+        for resp in responses
+    ):
+        logger.info("IMAP IDLE reported new mail")
+        return True
+    return False
+
 
 def idle_print_emails(
     host,
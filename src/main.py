@@ -1,18 +1,29 @@
 import asyncio
 import datetime
 import sys
+import threading
+import time
+from collections.abc import AsyncIterator, Callable
+from contextlib import aclosing
 from datetime import timedelta
+from functools import partial
 
-import pytz
+import httpx
 from dotenv import load_dotenv
+from pydantic_ai import Agent
 from pydantic_ai.models import Model
-from sqlalchemy.exc import IntegrityError
-from sqlmodel import SQLModel
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlmodel import Session
 
-from src.db import engine
-from src.events.caldav import add_to_caldav
-from src.mail import mail
-from src.model.ai import DockerCredential, OllamaCredential, OpenAICredential
+from src.db import SessionLocal, create_db, write_session
+from src.events.caldav import push_to_caldav
+from src.mail import mail, mail_idle
+from src.model.ai import (
+    Credential,
+    DockerCredential,
+    OllamaCredential,
+    OpenAICredential,
+)
 from src.model.email import EMail, EMailType
 from src.model.event import Event
 from src.util import ai
@@ -27,99 +38,286 @@ from src.util.notifications import send_failure_notification, send_success_notif
 from util.healthcheck import healthcheck
 from util.logging import logger
 
+CREDENTIAL_BUILDERS: dict[Provider, Callable[[Settings], Credential]] = {
+    Provider.DOCKER: lambda settings: DockerCredential(
+        host=settings.HOST,
+        port=settings.PORT,
+        secure=settings.SECURE,
+    ),
+    Provider.OLLAMA: lambda settings: OllamaCredential(
+        host=settings.HOST,
+        port=settings.PORT,
+        secure=settings.SECURE,
+    ),
+    Provider.OPENAI: lambda settings: OpenAICredential(
+        api_key=settings.OPEN_AI_API_KEY,
+    ),
+}
 
-def create_model(settings: Settings) -> Model:
-    if settings.AI_PROVIDER == Provider.DOCKER:
-        credential = DockerCredential(
-            host=settings.HOST,
-            port=settings.PORT,
-            secure=settings.SECURE,
-        )
-    elif settings.AI_PROVIDER == Provider.OLLAMA:
-        credential = OllamaCredential(
-            host=settings.HOST,
-            port=settings.PORT,
-            secure=settings.SECURE,
-        )
-    elif settings.AI_PROVIDER == Provider.OPENAI:
-        credential = OpenAICredential(
-            api_key=settings.OPEN_AI_API_KEY,
-        )
-    else:
+
+def create_model(
+    settings: Settings, http_client: httpx.AsyncClient | None = None
+) -> Model:
+    credential_builder = CREDENTIAL_BUILDERS.get(settings.AI_PROVIDER)
+    if credential_builder is None:
         logger.error("Unsupported AI provider: %s", settings.AI_PROVIDER)
         raise ValueError(f"Unsupported AI provider: {settings.AI_PROVIDER}")
 
     return build_model(
         settings.AI_PROVIDER,
         settings.AI_MODEL,
-        credential,
+        credential_builder(settings),
+        settings.AI_MAX_TOKENS,
+        http_client,
     )
 
 
-async def generate_events_from_email(
-    email: EMail, settings: Settings, model: Model
-) -> list[Event]:
-    logger.info("Generating events from email id %d", email.id)
-    if email.email_type == EMailType.HTML:
-        logger.debug("Converting HTML email to Markdown for email id %d", email.id)
-        email.body = ai.html_to_md(email.body)
+def create_agent(
+    settings: Settings, http_client: httpx.AsyncClient | None = None
+) -> Agent:
+    return build_agent(create_model(settings, http_client), settings.AI_MAX_RETRIES)
 
-    agent = build_agent(model, email, settings.AI_MAX_RETRIES)
 
-    deps = AgentDependencies(email=email)
+def create_http_client(settings: Settings) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(settings.AI_TIMEOUT, connect=10),
+        limits=httpx.Limits(max_keepalive_connections=settings.AI_CONCURRENCY),
+    )
 
-    results = await agent.run(email.body, deps=deps)
-    events: list[Event] = results.output.events
 
+def _normalize_event(event: Event, emails: dict[int, EMail]) -> Event | None:
+    # A single email owns every event, a batch is split on the labelled id
+    if len(emails) == 1:
+        event.email_id = next(iter(emails))
+    elif event.email_id not in emails:
+        logger.warning("Dropping event '%s' with unknown email id", event.summary)
+        return None
     # update the type for `start` and `end` to be datetime objects
-    for event in events:
-        if isinstance(event.start, str):
-            event.start = datetime.datetime.fromisoformat(event.start)
-        if isinstance(event.end, str):
-            event.end = datetime.datetime.fromisoformat(event.end)
+    if isinstance(event.start, str):
+        event.start = datetime.datetime.fromisoformat(event.start)
+    if isinstance(event.end, str):
+        event.end = datetime.datetime.fromisoformat(event.end)
+    return event
+
+
+async def stream_events(
+    emails: list[EMail],
+    settings: Settings,
+    agent: Agent,
+    cache_keys: dict[int, str],
+    queue: asyncio.Queue[tuple[int, list[Event]] | None],
+):
+    """
+    Run the agent for a batch of emails and queue each email's events once complete.
+    The emails are labelled in batch order, so once the model writes an event for an
+    email every email before it is complete. Each email is queued once, events the
+    model adds to an already queued email are queued again at the end.
+    :param emails: The emails to generate events from.
+    :param settings: The settings for the run.
+    :param agent: The agent to generate the events with.
+    :param cache_keys: The response cache keys of the emails, empty if not caching.
+    :param queue: The queue to put `(email_id, events)` on, `None` marks the end.
+    """
+    emails_by_id = {email.id: email for email in emails}
+    position = {email.id: index for index, email in enumerate(emails)}
+    events_by_email: dict[int, list[Event]] = {email.id: [] for email in emails}
+    late_events: dict[int, list[Event]] = {}
+    queued = 0
+    received = 0
+
+    def receive(new_events: list[Event]):
+        nonlocal queued
+        for event in new_events:
+            event = _normalize_event(event, emails_by_id)
+            if event is None:
+                continue
+            events_by_email[event.email_id].append(event)
+            if position[event.email_id] < queued:
+                logger.warning(
+                    "Event '%s' arrived after email id %d was saved",
+                    event.summary,
+                    event.email_id,
+                )
+                late_events.setdefault(event.email_id, []).append(event)
+                continue
+            for email in emails[queued : position[event.email_id]]:
+                queue.put_nowait((email.id, list(events_by_email[email.id])))
+            queued = max(queued, position[event.email_id])
+
+    try:
+        with SessionLocal() as db:
+            deps = AgentDependencies(emails=emails_by_id, db=db)
+            async with asyncio.timeout(settings.AI_TIMEOUT):
+                async with agent.run_stream(
+                    ai.format_emails(emails), deps=deps
+                ) as stream:
+                    async for partial in stream.stream_output(debounce_by=0.05):
+                        # Only the last event of a partial output can still be incomplete
+                        complete = partial.events[:-1]
+                        receive(complete[received:])
+                        received = max(received, len(complete))
+                    output = await stream.get_output()
+        receive(output.events[received:])
+
+        for email_id, cache_key in cache_keys.items():
+            ai.cache_events(cache_key, events_by_email[email_id])
+
+        for email in emails[queued:]:
+            queue.put_nowait((email.id, events_by_email[email.id]))
+        for email_id, events in late_events.items():
+            queue.put_nowait((email_id, events))
+    finally:
+        queue.put_nowait(None)
+
+
+async def generate_events_from_emails(
+    emails: list[EMail], settings: Settings, agent: Agent
+) -> AsyncIterator[tuple[int, list[Event]]]:
+    email_ids = [email.id for email in emails]
+    logger.info("Generating events from email ids %s", email_ids)
+    ready: list[tuple[int, list[Event]]] = []
+    cache_keys: dict[int, str] = {}
+    pending: list[EMail] = []
+    for email in emails:
+        if settings.AI_CACHE:
+            cache_key = ai.get_cache_key(email, settings.AI_MODEL)
+            cached_events = ai.get_cached_events(cache_key, email.id)
+            if cached_events is not None:
+                logger.info("Using cached events for email id %d", email.id)
+                ready.append((email.id, cached_events))
+                continue
+            cache_keys[email.id] = cache_key
+        pending.append(email)
+
+    for email in pending:
+        if email.email_type == EMailType.HTML:
+            logger.debug("Converting HTML email to Markdown for email id %d", email.id)
+            # CPU bound, keep it off the event loop so other emails keep progressing
+            email.body = await asyncio.to_thread(ai.html_to_md, email.body)
 
-    return events
+    # Emails without any dates can't contain events, don't spend a model call on them
+    skipped = [email.id for email in pending if not ai.may_contain_events(email.body)]
+    if skipped:
+        logger.info(
+            "Skipping %d of %d emails without dates: %s",
+            len(skipped),
+            len(pending),
+            skipped,
+        )
+        ready.extend((email_id, []) for email_id in skipped)
+        pending = [email for email in pending if email.id not in skipped]
+        for email_id in skipped:
+            cache_keys.pop(email_id, None)
+
+    if not pending:
+        for item in ready:
+            yield item
+        return
+
+    # The model output is streamed by its own task, so the timeout only covers the
+    # model and the events of complete emails are saved while it keeps writing
+    queue: asyncio.Queue[tuple[int, list[Event]] | None] = asyncio.Queue()
+    producer = asyncio.create_task(
+        stream_events(pending, settings, agent, cache_keys, queue)
+    )
+    try:
+        for item in ready:
+            yield item
+        while (item := await queue.get()) is not None:
+            yield item
+        await producer
+    finally:
+        producer.cancel()
 
 
-async def schedule_run(task_coro, interval_seconds: int):
+async def schedule_run(task_coro, interval_seconds: int, start_idle=None):
     while True:
         logger.info("Checking for new emails to process...")
         start = asyncio.get_event_loop().time()
+        idle_client = None
+        if start_idle:
+            # IDLE starts before the run searches the mailbox, so mail arriving while
+            # the run is busy still wakes up the next one
+            try:
+                idle_client = await asyncio.to_thread(start_idle)
+            except Exception as e:  # noqa: BLE001
+                logger.warning("IMAP IDLE failed, falling back to polling: %s", e)
         try:
             await task_coro()
         except Exception:  # noqa: BLE001
             logger.exception("Unhandled exception in scheduled run")
         elapsed = asyncio.get_event_loop().time() - start
         sleep_for = max(0, int(interval_seconds - elapsed))
+        if idle_client:
+            # Wake up as soon as the server pushes new mail, the interval is a keepalive
+            logger.info("Waiting up to %.2f seconds for new emails", sleep_for)
+            stop = threading.Event()
+            try:
+                await asyncio.to_thread(
+                    mail_idle.wait_for_new_mail, idle_client, sleep_for, stop
+                )
+                continue
+            except Exception as e:  # noqa: BLE001
+                logger.warning("IMAP IDLE failed, falling back to polling: %s", e)
+                sleep_for = max(
+                    0, int(interval_seconds - (asyncio.get_event_loop().time() - start))
+                )
+            finally:
+                # Lets the waiting thread finish when the wait is cancelled on shutdown
+                stop.set()
         logger.info("Sleeping for %.2f seconds before next run", sleep_for)
         await asyncio.sleep(sleep_for)
 
 
-async def main(settings: Settings):
+async def run(settings: Settings):
+    # One HTTP client and agent serve every scheduled run and are closed on shutdown
+    async with create_http_client(settings) as http_client:
+        agent = create_agent(settings, http_client)
+        await schedule_run(
+            lambda: main(settings, agent),
+            interval_seconds=settings.INTERVAL_MINUTES * 60,
+            start_idle=(
+                partial(mail_idle.start_idle, settings) if settings.IMAP_IDLE else None
+            ),
+        )
+
+
+async def main(settings: Settings, agent: Agent):
     logger.info("Starting email retrieval process")
 
-    # Create tables if they don't exist
-    SQLModel.metadata.create_all(engine)
+    # Create tables and indexes if they don't exist
+    create_db()
+
+    if settings.AI_CACHE:
+        evicted = ai.evict_cached_events(settings.AI_CACHE_TTL_DAYS)
+        logger.debug("Evicted %d expired cache entries", evicted)
+
+    with SessionLocal() as session:
+        await process_emails(settings, agent, session)
+
 
+async def process_emails(settings: Settings, agent: Agent, session: Session):
     client = mail.authenticate(settings)
     try:
-        most_recent_email: EMail = EMail.get_most_recent()
+        most_recent_delivery_date = EMail.get_most_recent_delivery_date(session)
+        # End the read so no snapshot is held open while the mailbox is fetched
+        session.commit()
 
-        if most_recent_email:
+        if most_recent_delivery_date:
             logger.info(
                 "Searching for emails since: %s",
-                most_recent_email.delivery_date + timedelta(seconds=1),
+                most_recent_delivery_date + timedelta(seconds=1),
             )
 
             emails = mail.get_emails_by_filter(
                 client,
                 settings,
-                since=most_recent_email.delivery_date + timedelta(seconds=1),
+                since=most_recent_delivery_date + timedelta(seconds=1),
             )
         else:
             emails = mail.get_emails_by_filter(client, settings)
     except Exception as e:
-        logger.error("An error occurred while retrieving emails", e)
+        logger.error("An error occurred while retrieving emails: %s", e)
         raise
     finally:
         client.logout()
@@ -129,67 +327,164 @@ async def main(settings: Settings):
 
     logger.info("Retrieved %d emails", len(emails))
 
-    model = create_model(settings)
-
-    processed_email_ids = {email.id for email in EMail.get_all()}
+    # Only ask for the fetched ids instead of loading every stored email
+    processed_email_ids = EMail.get_existing_ids(
+        [email.id for email in emails], session
+    )
     emails = [email for email in emails if email.id not in processed_email_ids]
+    # The batches start their own write transactions on the session
+    session.commit()
 
     if emails:
+        batches = ai.batch_emails(
+            emails, settings.AI_BATCH_SIZE, settings.AI_BATCH_MAX_TOKENS
+        )
+        # Batches share the session, every write is committed before the next await
+        # so one batch never commits another's half-finished work
+        semaphore = asyncio.Semaphore(settings.AI_CONCURRENCY)
+
+        async def bounded_process_batch(batch: list[EMail]):
+            async with semaphore:
+                await process_batch(batch, settings, agent, session)
+
+        await asyncio.gather(*(bounded_process_batch(batch) for batch in batches))
+    else:
+        logger.info("No new emails to process.")
+
+
+async def process_batch(
+    emails: list[EMail],
+    settings: Settings,
+    agent: Agent,
+    session: Session,
+):
+    email_ids = [email.id for email in emails]
+    logger.info("Starting to process emails with ids %s", email_ids)
+    start_time = time.perf_counter()
+    try:
         for email in emails:
-            logger.info("Starting to process email with id %d", email.id)
-            start_time = datetime.datetime.now(tz=pytz.UTC)
+            email.save(session)
+        # Commit before handing off to the agent, its tools use their own
+        # sessions and must not wait on this write transaction
+        session.commit()
+        for email in emails:
+            if not email.body:
+                logger.warning("Email id %d has no body, skipping", email.id)
+        emails = [email for email in emails if email.body]
+        if not emails:
+            return
+        emails_by_id = {email.id: email for email in emails}
+        async with aclosing(
+            generate_events_from_emails(emails, settings, agent)
+        ) as generated_events:
+            async for email_id, events in generated_events:
+                await save_email_events(
+                    emails_by_id[email_id], events, settings, session
+                )
+    except Exception as e:  # noqa: BLE001
+        handle_failure(
+            f"Error generating events from email ids {email_ids}", e, settings, session
+        )
+    finally:
+        duration = time.perf_counter() - start_time
+        logger.info(
+            "Processing of email ids %s completed in %.2f seconds",
+            email_ids,
+            duration,
+        )
+
+
+async def save_email_events(
+    email: EMail, events: list[Event], settings: Settings, session: Session
+):
+    # A failure for one email must not drop the events of the rest of the batch
+    try:
+        await save_events(email, events, settings, session)
+    except Exception as e:  # noqa: BLE001
+        handle_failure(
+            f"Error saving events from email id {email.id}",
+            e,
+            settings,
+            session,
+        )
+
+
+async def save_events(
+    email: EMail,
+    events: list[Event],
+    settings: Settings,
+    session: Session,
+):
+    event_objs: list[Event] = []
+    with write_session(session):
+        for event in events:
+            logger.info("Saving event '%s' from email id %d", event.summary, email.id)
+            event.email_id = email.id
+
             try:
-                email.save()
-                if not email.body:
-                    logger.warning("Email id %d has no body, skipping", email.id)
-                    continue
-                events: list[Event] = await generate_events_from_email(
-                    email, settings, model
+                # Savepoint so a duplicate only discards this event
+                with session.begin_nested():
+                    event = event.save(session)
+                event_objs.append(event)
+            except IntegrityError:
+                # The save_event tool may have stored it already, it still has to
+                # reach the calendar
+                existing = Event.find_unique_event(
+                    event.start, event.end, event.summary, session
                 )
-                event_objs: list[Event] = []
-                for event in events:
-                    logger.info(
-                        "Saving event '%s' from email id %d", event.summary, email.id
-                    )
-                    event.email_id = email.id
-
-                    try:
-                        event = event.save()
-                        event_objs.append(event)
-                    except IntegrityError:
-                        logger.warning(
-                            "Event '%s' from email id %d already exists in the database, skipping",
-                            event.summary,
-                            email.id,
-                        )
-                logger.debug(
-                    "Generated the following events from email id %d: %s",
+                if existing and not existing.in_calendar:
+                    event_objs.append(existing)
+                    continue
+                logger.warning(
+                    "Event '%s' from email id %d already exists in the database, "
+                    "skipping",
+                    event.summary,
                     email.id,
-                    event_objs,
                 )
-                add_to_caldav(
-                    settings.CALDAV_URL,
-                    settings.CALDAV_USERNAME,
-                    settings.CALDAV_PASSWORD,
-                    settings.CALDAV_CALENDAR,
-                    event_objs,
-                )
-                send_success_notification(settings.APPRISE_URL, event_objs)
+    logger.debug(
+        "Generated the following events from email id %d: %s",
+        email.id,
+        event_objs,
+    )
+    # Committed before the CalDAV requests so no write transaction is held across them
+    session.commit()
+    pending = [event for event in event_objs if not event.in_calendar]
+    if pending:
+        # Detached while the thread updates them, the session is shared with the
+        # other batches and their flushes must not pick up half-written events
+        for event in pending:
+            session.expunge(event)
+        try:
+            # Only the network I/O leaves the loop, every database write stays on
+            # its thread
+            await asyncio.to_thread(
+                push_to_caldav,
+                settings.CALDAV_URL,
+                settings.CALDAV_USERNAME,
+                settings.CALDAV_PASSWORD,
+                settings.CALDAV_CALENDAR,
+                pending,
+            )
+        finally:
+            # Record every event that reached the calendar, even if a later one failed
+            for event in pending:
+                if event.in_calendar:
+                    event.save_to_caldav(session)
+        session.commit()
+    ai.invalidate_events_context()
+    send_success_notification(settings.APPRISE_URL, event_objs)
 
-            except Exception as e:  # noqa: BLE001
-                error_message = f"Error generating events from email id {email.id}"
-                logger.error(error_message, e)
-                send_failure_notification(settings.APPRISE_URL, error_message)
-            finally:
-                end_time = datetime.datetime.now(tz=pytz.UTC)
-                duration = (end_time - start_time).total_seconds()
-                logger.info(
-                    "Processing of email id %d completed in %.2f seconds",
-                    email.id,
-                    duration,
-                )
-    else:
-        logger.info("No new emails to process.")
+
+def handle_failure(
+    error_message: str, e: Exception, settings: Settings, session: Session
+):
+    # Keep whatever was staged before the failure
+    try:
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+    logger.error("%s: %s", error_message, e)
+    send_failure_notification(settings.APPRISE_URL, error_message)
 
 
 if __name__ == "__main__":
@@ -197,13 +492,7 @@ if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "healthcheck":
         healthcheck()
     else:
-        settings = get_settings()
         try:
-            asyncio.run(
-                schedule_run(
-                    lambda: main(settings),
-                    interval_seconds=settings.INTERVAL_MINUTES * 60,
-                )
-            )
+            asyncio.run(run(get_settings()))
         except KeyboardInterrupt:
             logger.info("Program interrupted by user, shutting down.")
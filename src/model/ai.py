@@ -1,24 +1,28 @@
+from dataclasses import dataclass
 from enum import Enum
 
-from pydantic import BaseModel
 
-
-class Credential(BaseModel):
+# Plain config holders built from the already validated settings
+@dataclass(slots=True, frozen=True)
+class Credential:
     pass
 
 
+@dataclass(slots=True, frozen=True)
 class OllamaCredential(Credential):
     host: str
     port: int
     secure: bool = False
 
 
+@dataclass(slots=True, frozen=True)
 class DockerCredential(Credential):
     host: str = "model-runner.docker.internal"
     port: int = 80
     secure: bool = False
 
 
+@dataclass(slots=True, frozen=True)
 class OpenAICredential(Credential):
     api_key: str
 
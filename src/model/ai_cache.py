@@ -0,0 +1,37 @@
+from datetime import UTC, datetime
+
+from sqlmodel import Field, SQLModel, delete, select
+
+from src.db import Session, read_session, write_session
+
+
+class AICache(SQLModel, table=True):
+    __tablename__ = "response_cache"
+
+    key: str = Field(primary_key=True)
+    events_json: str = Field(nullable=False)
+    created_at: datetime = Field(
+        nullable=False, index=True, default_factory=lambda: datetime.now(UTC)
+    )
+
+    def __repr__(self):
+        return f"<AICache(key={self.key})>"
+
+    def __str__(self):
+        return f"AICache(key={self.key})"
+
+    def save(self, session: Session | None = None):
+        with write_session(session) as db:
+            self.created_at = datetime.now(UTC)
+            db.merge(self)
+
+    @staticmethod
+    def get_by_key(key: str, session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(select(AICache).where(AICache.key == key)).first()
+
+    @staticmethod
+    def delete_expired(before: datetime, session: Session | None = None) -> int:
+        with write_session(session) as db:
+            result = db.exec(delete(AICache).where(AICache.created_at < before))
+            return result.rowcount
@@ -1,12 +1,16 @@
 import enum
+from collections.abc import Iterable
 from datetime import datetime
 
 import tzlocal
-from sqlmodel import Field, SQLModel, select
+from sqlmodel import Field, SQLModel, func, select
 
-from src.db import Session, engine
+from src.db import Session, SessionLocal, read_session, write_session
 from src.model.event import Event
 
+# Resolving the local zone reads /etc/localtime, so only do it once
+_LOCAL_TZ = tzlocal.get_localzone()
+
 
 class EMailType(enum.Enum):
     PLAIN = "plain"
@@ -17,10 +21,10 @@ class EMail(SQLModel, table=True):
     id: int = Field(primary_key=True)
     subject: str = Field(nullable=False)
     from_address: str = Field(nullable=False)
-    delivery_date: datetime = Field(nullable=False)
+    delivery_date: datetime = Field(nullable=False, index=True)
     body: str = Field(nullable=False)
     retrieved_date: datetime = Field(
-        nullable=False, default=lambda: datetime.now(tzlocal.get_localzone())
+        nullable=False, default_factory=lambda: datetime.now(_LOCAL_TZ)
     )
     email_type: EMailType = Field(nullable=False)
 
@@ -30,94 +34,83 @@ class EMail(SQLModel, table=True):
     def __str__(self):
         return f"EMail(id={self.id}, subject={self.subject}, from_address={self.from_address}, delivery_date={self.delivery_date})"
 
-    def save(self):
-        session = Session(engine)
-        try:
-            self.retrieved_date = datetime.now(tzlocal.get_localzone())
-            session.merge(self)
-            session.commit()
-        finally:
-            session.close()
+    def save(self, session: Session | None = None):
+        with write_session(session) as db:
+            self.retrieved_date = datetime.now(_LOCAL_TZ)
+            db.merge(self)
 
-    def get(self):
-        session = Session(engine)
-        try:
-            return session.exec(select(EMail).where(EMail.id == self.id)).first()
-        finally:
-            session.close()
+    def get(self, session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(select(EMail).where(EMail.id == self.id)).first()
 
-    def delete(self):
-        session = Session(engine)
+    def delete(self, session: Session | None = None):
+        owns_session = session is None
+        session = session or SessionLocal()
         try:
             session.delete(EMail.where(EMail.id == self.id))
             session.commit()
         finally:
-            session.close()
+            if owns_session:
+                session.close()
 
     @staticmethod
-    def get_by_id(email_id: int):
-        session = Session(engine)
-        try:
-            return session.exec(select(EMail).where(EMail.id == email_id)).first()
-        finally:
-            session.close()
+    def get_by_id(email_id: int, session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(select(EMail).where(EMail.id == email_id)).first()
 
     @staticmethod
-    def get_all():
-        session = Session(engine)
-        try:
-            return session.exec(select(EMail)).all()
-        finally:
-            session.close()
+    def get_all(session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(select(EMail)).all()
 
     @staticmethod
-    def get_by_delivery_date(delivery_date: datetime):
-        session = Session(engine)
-        try:
-            return session.exec(
+    def get_existing_ids(
+        email_ids: Iterable[int], session: Session | None = None
+    ) -> set[int]:
+        with read_session(session) as db:
+            return set(db.exec(select(EMail.id).where(EMail.id.in_(email_ids))).all())
+
+    @staticmethod
+    def get_by_delivery_date(delivery_date: datetime, session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(
                 select(EMail).where(EMail.delivery_date == delivery_date)
             ).all()
-        finally:
-            session.close()
 
     @staticmethod
-    def get_most_recent():
-        session = Session(engine)
-        try:
-            return session.exec(
-                select(EMail).order_by(EMail.delivery_date.desc())
+    def get_most_recent(session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(
+                select(EMail).order_by(EMail.delivery_date.desc()).limit(1)
             ).first()
-        finally:
-            session.close()
 
     @staticmethod
-    def get_most_recent_without_events():
-        session = Session(engine)
-        try:
-            email: EMail = session.exec(
-                select(EMail).order_by(EMail.delivery_date.desc())
+    def get_most_recent_delivery_date(
+        session: Session | None = None,
+    ) -> datetime | None:
+        with read_session(session) as db:
+            return db.exec(select(func.max(EMail.delivery_date))).one()
+
+    @staticmethod
+    def get_most_recent_without_events(session: Session | None = None):
+        with read_session(session) as db:
+            email: EMail = db.exec(
+                select(EMail).order_by(EMail.delivery_date.desc()).limit(1)
             ).first()
             # Check if this email has any associated events
             if email:
-                event = session.exec(
-                    select(Event).where(Event.email_id == email.id)
-                ).first()
+                event = db.exec(select(Event).where(Event.email_id == email.id)).first()
                 if event:
                     return None  # The most recent email has associated events
             return email
-        finally:
-            session.close()
 
     @staticmethod
-    def get_without_events():
-        session = Session(engine)
-        try:
+    def get_without_events(session: Session | None = None):
+        with read_session(session) as db:
             # Use NOT EXISTS to find emails with no events referencing them
-            result = session.exec(
+            result = db.exec(
                 select(EMail).where(
                     ~select(Event).where(Event.email_id == EMail.id).exists()
                 )
             ).all()
             return result
-        finally:
-            session.close()
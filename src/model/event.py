@@ -3,9 +3,10 @@ from datetime import datetime
 from sqlalchemy import (
     UniqueConstraint,
 )
+from sqlalchemy.dialects.sqlite import insert
 from sqlmodel import Field, SQLModel, select
 
-from src.db import Session, engine
+from src.db import Session, SessionLocal, read_session, write_session
 
 
 class Event(SQLModel, table=True):
@@ -23,6 +24,7 @@ class Event(SQLModel, table=True):
     )
     end: datetime = Field(
         nullable=False,
+        index=True,
         description="The end date and time of the event, must be a Python datetime object, cannot be None",
     )
     all_day: bool = Field(
@@ -36,6 +38,7 @@ class Event(SQLModel, table=True):
     email_id: int = Field(
         foreign_key="email.id",
         nullable=True,
+        index=True,
         description="The ID of the email from which this event was created, use the `get_email_id` tool to get determine this value.",
     )
     in_calendar: bool = Field(
@@ -53,101 +56,119 @@ class Event(SQLModel, table=True):
     def __str__(self):
         return f"Event(id={self.id}, start={self.start}, end={self.end}, summary={self.summary})"
 
-    def save(self):
-        session = Session(engine)
-        try:
+    def save(self, session: Session | None = None):
+        with write_session(session) as db:
             if isinstance(self.start, str):
                 self.start = datetime.fromisoformat(self.start)
             if isinstance(self.end, str):
                 self.end = datetime.fromisoformat(self.end)
             self.summary = self.summary.lower()
-            if self.id:
-                self.caldav_id = Event.get_by_id(self.id).caldav_id
-            event = session.merge(self)
-            session.commit()
-            session.flush()
-            session.refresh(event)
-            return event
-        finally:
-            session.close()
-
-    def get(self):
-        session = Session(engine)
-        try:
-            return session.exec(select(Event).where(Event.id == self.id)).first()
-        finally:
-            session.close()
-
-    def delete(self):
-        session = Session(engine)
+            # Single UPSERT; caldav_id is left out of the update so an existing
+            # event keeps the CalDAV id it was created with
+            stmt = (
+                insert(Event)
+                .values(**self.model_dump(exclude={"id"} if self.id is None else None))
+                .on_conflict_do_update(
+                    index_elements=[Event.id],
+                    set_={
+                        "start": self.start,
+                        "end": self.end,
+                        "all_day": self.all_day,
+                        "summary": self.summary,
+                        "email_id": self.email_id,
+                        "in_calendar": self.in_calendar,
+                    },
+                )
+                .returning(Event)
+                .execution_options(populate_existing=True)
+            )
+            return db.exec(stmt).scalar_one()
+
+    def get(self, session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(select(Event).where(Event.id == self.id)).first()
+
+    def delete(self, session: Session | None = None):
+        owns_session = session is None
+        session = session or SessionLocal()
         try:
             session.delete(Event.where(Event.id == self.id))
             session.commit()
         finally:
-            session.close()
+            if owns_session:
+                session.close()
 
-    def save_to_caldav(self):
-        session = Session(engine)
-        try:
+    def save_to_caldav(self, session: Session | None = None):
+        with write_session(session) as db:
             self.in_calendar = True
-            session.merge(self)
-            session.commit()
-        finally:
-            session.close()
+            db.merge(self)
 
     @staticmethod
-    def get_by_id(event_id: int):
-        session = Session(engine)
-        try:
-            return session.exec(select(Event).where(Event.id == event_id)).first()
-        finally:
-            session.close()
+    def get_by_id(event_id: int, session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(select(Event).where(Event.id == event_id)).first()
 
     @staticmethod
-    def get_all():
-        session = Session(engine)
-        try:
-            return session.exec(select(Event)).all()
-        finally:
-            session.close()
+    def get_all(session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(select(Event)).all()
 
     @staticmethod
-    def get_by_date(date: datetime):
-        session = Session(engine)
-        try:
-            return session.exec(
-                select(Event).where(Event.start == date or Event.end == date)
+    def get_starting_between(
+        start: datetime, end: datetime, limit: int, session: Session | None = None
+    ):
+        with read_session(session) as db:
+            return db.exec(
+                select(Event)
+                .where(Event.start >= start, Event.start <= end)
+                .order_by(Event.start)
+                .limit(limit)
             ).all()
-        finally:
-            session.close()
 
     @staticmethod
-    def get_not_in_calendar():
-        session = Session(engine)
-        try:
-            return session.exec(select(Event).where(not Event.in_calendar)).all()
-        finally:
-            session.close()
+    def get_by_date(date: datetime, session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(
+                select(Event).where((Event.start == date) | (Event.end == date))
+            ).all()
 
     @staticmethod
-    def get_max_id():
-        session = Session(engine)
-        try:
-            max_id = session.exec(select(Event.id).order_by(Event.id.desc())).first()
+    def get_not_in_calendar(session: Session | None = None):
+        with read_session(session) as db:
+            return db.exec(select(Event).where(not Event.in_calendar)).all()
+
+    @staticmethod
+    def get_max_id(session: Session | None = None):
+        with read_session(session) as db:
+            max_id = db.exec(select(Event.id).order_by(Event.id.desc())).first()
             return max_id if max_id is not None else 1
-        finally:
-            session.close()
 
     @staticmethod
-    def find_unique_event(start: datetime, end: datetime, summary: str):
-        session = Session(engine)
-        try:
-            return session.exec(
+    def find_unique_event(
+        start: datetime, end: datetime, summary: str, session: Session | None = None
+    ):
+        with read_session(session) as db:
+            return db.exec(
                 select(Event).where(
                     Event.start == start,
                     Event.end == end,
                     Event.summary == summary.lower(),
                 )
             ).first()
-        finally:
-            session.close()
+
+    @staticmethod
+    def find_unique_event_with_delivery_date(
+        start: datetime, end: datetime, summary: str, session: Session | None = None
+    ) -> tuple["Event", datetime] | None:
+        from src.model.email import EMail
+
+        with read_session(session) as db:
+            return db.exec(
+                select(Event, EMail.delivery_date)
+                .join(EMail, EMail.id == Event.email_id)
+                .where(
+                    Event.start == start,
+                    Event.end == end,
+                    Event.summary == summary.lower(),
+                )
+            ).first()
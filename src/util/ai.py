@@ -1,18 +1,29 @@
+import re
+import time
 from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from functools import lru_cache
+from hashlib import blake2b
 
+import httpx
 import markdownify
-from bs4 import BeautifulSoup
-from pydantic import BaseModel, Field
-from pydantic_ai import Agent, ModelSettings, RunContext
+from pydantic import BaseModel, Field, TypeAdapter
+from pydantic_ai import Agent, ModelRetry, ModelSettings, RunContext
 from pydantic_ai.models import Model
 from pydantic_ai.models.openai import OpenAIChatModel
 from pydantic_ai.providers.ollama import OllamaProvider
 from pydantic_ai.providers.openai import OpenAIProvider
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
 
-from src.db import engine
-from src.model.ai import Credential, Provider
+from src.db import Session
+from src.model.ai import (
+    Credential,
+    DockerCredential,
+    OllamaCredential,
+    OpenAICredential,
+    Provider,
+)
+from src.model.ai_cache import AICache
 from src.model.email import EMail
 from src.model.event import Event
 from util.logging import logger
@@ -20,155 +31,275 @@ from util.logging import logger
 
 @dataclass
 class AgentDependencies:
-    email: EMail
-    db = Session(engine)
+    emails: dict[int, EMail]
+    # Scoped to a single run, so its identity map never outlives the emails it served
+    db: Session
+
+    def get_email(self, email_id: int | None = None) -> EMail:
+        # With a single email the id is optional, in a batch it picks the email
+        if len(self.emails) == 1:
+            return next(iter(self.emails.values()))
+        if email_id is None:
+            raise ModelRetry("Several emails are being parsed, pass the email_id")
+        if email_id not in self.emails:
+            raise ModelRetry(f"Unknown email_id {email_id}, use an id from the labels")
+        return self.emails[email_id]
+
+    def release(self):
+        # End the read transaction so its pooled connection isn't held while the
+        # model works on the next response
+        self.db.commit()
 
 
 class Events(BaseModel):
     events: list[Event] = Field(description="A list of events parsed from the email")
 
 
+_HTML_TAG_RE = re.compile(r"<[a-zA-Z/][^>]{0,64}>")
+_SCRIPT_STYLE_RE = re.compile(
+    r"<(script|style)\b[^>]*>.*?</\1\s*>", re.IGNORECASE | re.DOTALL
+)
+_MD_CONVERTER = markdownify.MarkdownConverter(heading_style="ATX")
+
+
+# Newsletters often repeat the same body, and str caches its own hash so lookups are cheap
+@lru_cache(maxsize=128)
 def html_to_md(html: str) -> str:
     """
     Convert HTML content to Markdown format.
+    Content without any HTML tags is returned unchanged, results are memoized.
     :param html: The HTML content to convert.
     :return: The converted Markdown content.
     """
-    soup = BeautifulSoup(html, "html.parser")
-    text = str(soup)
-    md = markdownify.markdownify(text, heading_style="ATX")
+    if not _HTML_TAG_RE.search(html):
+        return html
+    html = _SCRIPT_STYLE_RE.sub("", html)
+    # markdownify parses the HTML itself, no need to round trip it through a soup
+    md = _MD_CONVERTER.convert(html)
     return md
 
 
-def get_system_prompt(email: EMail) -> str:
-    persona = """Act as a high level personal assistant for a C level executive who's main responsibility is managing 
-    their calendar and scheduling meetings from emails they receive."""
-
-    context = """You are going to parse emails, that are in markdown format, and extract calendar events from them.
-    The `email_id` is {email_id}, use this for ALL events you extract from this email.
-    If there is a FOUR DIGIT year, before any month i.e, 2023, use that year for all dates, otherwise use the current year is {current_year}.
-    There can be a heading that is a short of long month name i.e., 'Oct' or 'October' on a new line
-    Subsequent lines can can contain a date number or a range of dates, i.e, 22-23 or 24
-    After the date or date range, there CAN be an OPTIONAL time, i.e., 11 am or 2:50, or 12, these must be converted into ISO-8601 strings.
-    After OPTIONAL time, there will be a summary of the event, this must be formatted in `Sentence case`.
-    After an event, there CAN be an 0 or more lines that are the same as the above line. If there is no DATE this should take the date of the last event, otherwise it has a new date.
-    There can then be 0 or more new lines, before the next month heading, and the same rules apply.
-    If the months loops, i.e, the previous month was before or December and the new month is January or later, increment the year by 1.
-    Here is an example of the format:
-        INPUT:
-            **October**  
-            22-23 Mum/Dad Gwen Chicago  
-            24 Katie Drs
-            
-            **November**
-            
-            9 2pm Mark Dudley  
-            
-            19-27 Jack/Cam Thanksgiving
-            
-            25 11 am Nurse Phone Call Mark Gastro
-            
-            26 Family+Nana Tallgrass 6pm
-            
-            *2024*
-            **January**  
-            3 2:50 Dentist Cam CANCELLED - on wait list
-        OUTPUT:
-        [{
-            "start": "2023-10-22",
-            "end": "2023-10-23",
-            "all_day": true,
-            "summary": Mum/Dad Gwen Chicago
-        },
-        {
-            "start": "2023-10-24",
-            "end": "2023-10-24",
-            "all_day": true,
-            "summary": "Katie Drs"
-        },
-        {
-            "start": "2023-11-09T14:00:00",
-            "end": "2023-11-09T15:00:00",
-            "all_day": false,
-            "summary": "Mark Dudley"
-        },
-        {
-            "start": "2023-11-19",
-            "end": "2023-11-27",
-            "all_day": true,
-            "summary": "Jack/Cam Thanksgiving"
-        },
-        {
-            "start": "2023-11-25T11:00:00",
-            "end": "2023-11-25T12:00:00",
-            "all_day": false,
-            "summary": "Nurse Phone Call Mark Gastro"
-        },
-        {
-            "start": "2023-11-26T18:00:00",
-            "end": "2023-11-26T19:00:00",
-            "all_day": false,
-            "summary": "Family+Nana Tallgrass"
-        },
-        {
-            "start": "2024-01-03T14:50:00",
-            "end": "2024-01-03T15:50:00",
-            "all_day": false,
-            "summary": "Dentist Cam CANCELLED - on wait list"
-        }]]
-    """.replace("{email_id}", str(email.id)).replace(
-        "{current_year}", str(email.delivery_date.year)
+_MONTH_RE = re.compile(
+    r"\b(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?"
+    r"|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\b",
+    re.IGNORECASE,
+)
+_DAY_RE = re.compile(r"\b\d{1,2}(?:st|nd|rd|th)?\b", re.IGNORECASE)
+_NUMERIC_DATE_RE = re.compile(r"\b\d{1,4}[-/.]\d{1,2}(?:[-/.]\d{1,4})?\b")
+
+
+def may_contain_events(body: str) -> bool:
+    """
+    Cheaply check whether an email body could contain any events.
+    A body needs a month name with a day number, or a numeric date, to be worth
+    sending to the AI.
+    :param body: The Markdown or plain text body of the email.
+    :return: False if the body can't contain an event, True otherwise.
+    """
+    if _NUMERIC_DATE_RE.search(body):
+        return True
+    return bool(_MONTH_RE.search(body) and _DAY_RE.search(body))
+
+
+class CachedEvent(BaseModel):
+    start: datetime
+    end: datetime
+    all_day: bool = False
+    summary: str
+
+
+# Decodes and validates the cached JSON in a single pass in pydantic-core
+_CACHED_EVENTS_ADAPTER = TypeAdapter(list[CachedEvent])
+
+_QUOTED_LINE_RE = re.compile(r"^[ \t]*>.*$", re.MULTILINE)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def get_cache_key(email: EMail, model_name: str) -> str:
+    """
+    Build the response cache key for an email from its normalized body.
+    Quoted reply lines and whitespace differences are ignored, and the delivery year is
+    included since the prompt resolves dates without a year against it. The model and
+    the prompt version are part of the key, so changing either starts a fresh cache.
+    :param email: The email to build the key for.
+    :param model_name: The name of the model parsing the email.
+    :return: The hex digest used as the cache key.
+    """
+    body = _QUOTED_LINE_RE.sub("", email.body)
+    body = _WHITESPACE_RE.sub(" ", body).strip().lower()
+    return blake2b(
+        f"{model_name}\n{PROMPT_VERSION}\n{email.delivery_date.year}\n{body}".encode(),
+        digest_size=32,
+    ).hexdigest()
+
+
+def get_cached_events(key: str, email_id: int) -> list[Event] | None:
+    """
+    Look up previously generated events for a cache key.
+    :param key: The cache key from `get_cache_key`.
+    :param email_id: The ID of the email the events are for.
+    :return: The cached events, or None on a cache miss.
+    """
+    cached = AICache.get_by_key(key)
+    if cached is None:
+        return None
+    # Already validated while decoding, so build the table models directly
+    return [
+        Event(**event.model_dump(), email_id=email_id)
+        for event in _CACHED_EVENTS_ADAPTER.validate_json(cached.events_json)
+    ]
+
+
+def cache_events(key: str, events: list[Event]):
+    """
+    Store generated events under a cache key.
+    :param key: The cache key from `get_cache_key`.
+    :param events: The events generated for the email.
+    """
+    events_json = _CACHED_EVENTS_ADAPTER.dump_json(
+        [CachedEvent.model_validate(event, from_attributes=True) for event in events]
+    ).decode()
+    AICache(key=key, events_json=events_json).save()
+
+
+def evict_cached_events(ttl_days: int) -> int:
+    """
+    Remove cached events older than the time to live.
+    :param ttl_days: The number of days cached events are kept for.
+    :return: The number of removed cache entries.
+    """
+    return AICache.delete_expired(datetime.now(UTC) - timedelta(days=ttl_days))
+
+
+def batch_emails(
+    emails: list[EMail], max_emails: int, max_tokens: int
+) -> list[list[EMail]]:
+    """
+    Group emails into batches that are parsed by a single AI request.
+    Tokens are estimated as a quarter of the body length, an email larger than the
+    budget on its own still gets a batch of its own.
+    :param emails: The emails to group, in processing order.
+    :param max_emails: The maximum number of emails in a batch.
+    :param max_tokens: The approximate token budget for the bodies of a batch.
+    :return: The batches of emails.
+    """
+    batches: list[list[EMail]] = []
+    batch: list[EMail] = []
+    batch_tokens = 0
+    for email in emails:
+        tokens = len(email.body or "") // 4
+        if batch and (len(batch) >= max_emails or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(email)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def format_emails(emails: list[EMail]) -> str:
+    """
+    Build the user message for the emails of a single AI request.
+    Each email is labelled with its ID and year, keeping the system prompt identical
+    between runs so providers can reuse its cached prefix.
+    :param emails: The emails to include.
+    :return: The user message.
+    """
+    return "\n---\n".join(
+        f"[email_id={email.id} year={email.delivery_date.year}]\n{email.body}"
+        for email in emails
     )
 
-    tools = """You have the following tools available to you:
-   
-    # get_current_email_delivery_date
-        - Description: Get the delivery date of the email being processed
-        - Input: None
-        - Output: A string representing the email delivery date in ISO-8601 format (YYYY-MM-DDTHH:MM:SS)
-        
-    # get_delivery_date_by_event
-        - Description: Get the delivery date of an email by its event's email ID
-        - Input: The event to find the delivery date for
-        - Output: A string representing the email delivery date in ISO-8601 format (YYYY-MM-DDTHH:MM:SS) or null if the email ID does not exist"""
-
-    '''# save_event
-        - Description: Save the event to the database
-        - Input: The event object to save
-        - Output: A boolean indicating whether the save was successful, true if successful, false otherwise
-        - Note: This tool MUST be called for each event you return to ensure it is saved in the database. If the tool returns false, the event already exists and was not saved, following the matching rules to update the event.
-        
-    # get_events
-        - Description: Get all existing events from the database
-        - Input: None
-        - Output: A list of existing event objects or null if no events exist
-        - Note: This tool MUST be called after each `save_event` call to get the most up-to-date list of events in the database, and to avoid duplicate events.
-    """'''
-
-    matching = """An event is considered a duplicate if the summary has a similar meaning and the `start` and `end` fields are around the same time.
-        Example: Jack dentist and dentist appointment for Jack are considered similar.
-        Example: An event on 2023-10-22 and another on 2023-10-23, both with the summary of `Jack dentist` are considered around the same time.
-        Example: An event on 2023-10-22T10:00:00 and another on 2024-10-22T11:00:00, both with the summary of `Jack dentist` are NOT considered around the same time.
-    If you find a similar event, make sure the `event.id` has the same value as the existing event in the database.
-    Use the `get_delivery_date_by_event` tool to get the delivery date of the existing using the existing event's id. This tool MUST be run for each existing event found.
-    Use the `get_current_email_delivery_date` tool to get the delivery date of the current. This tool MUST be run once if any existing events are found.
-    Whichever delivery date is the most recent, use that event's `summary`, `start`, `end`, and `email_id` when returning the event.
-    If there is no existing event found, set the `id` to `None`."""
-
-    assumptions = """These are the following assumptions you are allowed to make when parsing the email:
-    - If an event spans multiple days, it is an all-day event."""
-
-    failure_message = """If there are no events found within the context or the email, respond with an empty array: [].
-    If you cannot parse an event line fully or are not 100% sure of the result, skip that line and do not include it in the output, it is better to miss an event than to include an incorrect one.
-    If an event has an invalid `"start"`, `"end"`, skip that event and do not include it in the output."""
 
-    output = """You must respond with a JSON array of objects, each object representing a calendar event with the following fields:
-    - "start": The star" date of the event in ISO-8601 format (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS).
-    - "end": The end date of the event in ISO-8601 format (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS).
-    - "all_day": A boolean indicating whether the event is an all-day event (true) or has a specific time (false).
-    - "summary": A brief summary or title of the event in Sentence case."""
+# Existing events near the emails being parsed, rendered compactly into the prompt
+EVENTS_CONTEXT_BEFORE = timedelta(days=60)
+EVENTS_CONTEXT_AFTER = timedelta(days=180)
+EVENTS_CONTEXT_LIMIT = 200
+EVENTS_CONTEXT_TTL_SECONDS = 60
+
+_events_context_cache: dict[tuple[datetime, datetime], tuple[float, str]] = {}
+
+
+def get_events_window(emails: list[EMail]) -> tuple[datetime, datetime]:
+    """
+    Get the window of event start dates that are relevant to the emails.
+    The window is widened to whole days so emails delivered on the same day share it.
+    :param emails: The emails being parsed.
+    :return: The start and end of the window.
+    """
+    delivery_dates = [email.delivery_date for email in emails]
+    start = min(delivery_dates) - EVENTS_CONTEXT_BEFORE
+    end = max(delivery_dates) + EVENTS_CONTEXT_AFTER
+    return (
+        start.replace(hour=0, minute=0, second=0, microsecond=0),
+        end.replace(hour=23, minute=59, second=59, microsecond=999999),
+    )
+
+
+def get_events_context(emails: list[EMail], session: Session | None = None) -> str:
+    """
+    Render the existing events around the delivery dates of the emails.
+    Only events starting in a window around the emails are included, one
+    `id|start|end|summary` line each. The result is cached for a short time so
+    bursts of emails reuse it, saving events clears the cache.
+    :param emails: The emails being parsed.
+    :param session: An optional session to query with.
+    :return: The rendered events, or an empty string if there are none.
+    """
+    window = get_events_window(emails)
+    now = time.monotonic()
+    cached = _events_context_cache.get(window)
+    if cached is not None and now - cached[0] < EVENTS_CONTEXT_TTL_SECONDS:
+        return cached[1]
+
+    events = Event.get_starting_between(*window, EVENTS_CONTEXT_LIMIT, session)
+    context = "\n".join(
+        f"{event.id}|{event.start.isoformat()}|{event.end.isoformat()}|{event.summary}"
+        for event in events
+    )
+    _events_context_cache[window] = (now, context)
+    return context
+
+
+def invalidate_events_context():
+    _events_context_cache.clear()
+
+
+def get_system_prompt() -> str:
+    persona = "Act as a personal assistant who turns the schedule emails a family receives into calendar events."
+
+    context = """Every email is in Markdown and starts with an `[email_id=<id> year=<year>]` label, several emails are separated by `---`.
+    1. Use the labelled `email_id` for every event of that email, never mix events between emails.
+    2. A line with a short or long month name, i.e. `Oct` or `**October**`, starts that month. A FOUR DIGIT year line, i.e. `*2024*`, sets the year, otherwise use the labelled `year`. When the months loop past December, increment the year.
+    3. An event line starts with a day or a day range, i.e. `24` or `22-23`, then an OPTIONAL time, i.e. `11 am`, `2:50` or `6pm`, then the summary. A line without a day uses the day of the previous event.
+    4. An event with a time lasts one hour, `start` and `end` are `YYYY-MM-DDTHH:MM:SS`. Without a time, or when it spans several days, it is `all_day` and `start` and `end` are `YYYY-MM-DD`.
+    5. The `summary` is the rest of the line in Sentence case.
+    Example, `[email_id=7 year=2023]`:
+        **October**
+        22-23 Mum/Dad Gwen Chicago
+        **November**
+        9 2pm Mark Dudley
+        26 Family+Nana Tallgrass 6pm
+    gives:
+        {"start": "2023-10-22", "end": "2023-10-23", "all_day": true, "summary": "Mum/Dad Gwen Chicago", "email_id": 7}
+        {"start": "2023-11-09T14:00:00", "end": "2023-11-09T15:00:00", "all_day": false, "summary": "Mark Dudley", "email_id": 7}
+        {"start": "2023-11-26T18:00:00", "end": "2023-11-26T19:00:00", "all_day": false, "summary": "Family+Nana Tallgrass", "email_id": 7}"""
 
-    return f"{persona}\n\n{context}\n\n{tools}\n\n{matching}\n\n{assumptions}\n\n{failure_message}\n\n{output}"
+    matching = """An event is a duplicate of an existing event when the summary means the same, i.e. `Jack dentist` and `Dentist appointment for Jack`, and it is within a day of it.
+    For a duplicate, compare `get_delivery_date_by_event` for the existing event with `get_current_email_delivery_date` for the email, return the values of the newer one with the existing event's `id`.
+    Events without a duplicate have no `id`."""
+
+    failure_message = """Only return events you are sure of, skip lines you cannot fully parse or with an invalid date, it is better to miss an event than to include an incorrect one.
+    Return no events if there are none."""
+
+    return f"{persona}\n\n{context}\n\n{matching}\n\n{failure_message}"
+
+
+# The static instructions are the same for every run, so assemble them once at import
+SYSTEM_PROMPTS = (get_system_prompt(),)
+# Changes whenever the instructions do, so cached responses of an older prompt are not reused
+PROMPT_VERSION = blake2b("\n".join(SYSTEM_PROMPTS).encode(), digest_size=8).hexdigest()
 
 
 def get_cleanup_system_prompt() -> str:
@@ -190,51 +321,68 @@ def get_cleanup_system_prompt() -> str:
     return f"{persona}\n\n{task}\n\n{failure_message}\n\n{output}"
 
 
-def build_model(provider: Provider, model_name: str, credential: Credential) -> Model:
+def build_model(
+    provider: Provider,
+    model_name: str,
+    credential: Credential,
+    max_tokens: int | None = None,
+    http_client: httpx.AsyncClient | None = None,
+) -> Model:
     """
     Build and return an AI model based on the specified provider, model name, and credentials.
     :param provider: The AI provider to use (OLLAMA, OPENAI, DOCKER).
     :param model_name: The name of the model to use.
     :param credential: The credentials required for the specified provider.
+    :param max_tokens: The maximum number of tokens the model may generate per request.
+    :param http_client: An optional HTTP client shared by the provider's requests.
     :return: An instance of the specified AI model.
-    :raises ValueError: If the specified provider is unsupported.
+    :raises ValueError: If the provider is unsupported or doesn't match the credential.
     """
-    settings = ModelSettings(
-        temperature=0.2,
-    )
-    if provider == Provider.OLLAMA:
-        logger.debug("Building Ollama model")
-        base_url = f"{'https://' if credential.secure else 'http://'}{credential.host}:{credential.port}/v1"
-        logger.debug("Ollama base URL: %s", base_url)
-        return OpenAIChatModel(
-            model_name=model_name,
-            provider=OllamaProvider(base_url=base_url),
-            settings=settings,
-        )
-    elif provider == Provider.OPENAI:
-        logger.debug("Building OpenAI model")
-        return OpenAIChatModel(
-            model_name=model_name,
-            provider=OpenAIProvider(api_key=credential.api_key),
-            settings=settings,
-        )
-    elif provider == Provider.DOCKER:
-        logger.debug("Building Docker model")
-        base_url = f"{'https://' if credential.secure else 'http://'}{credential.host}:{credential.port}/engines/v1"
-        logger.debug("Docker base URL: %s", base_url)
-        return OpenAIChatModel(
-            model_name=model_name,
-            provider=OllamaProvider(base_url=base_url),
-            settings=settings,
-        )
-    else:
-        raise ValueError(f"Unsupported provider: {provider}")
-
-
-def build_agent(model: Model, email: EMail, max_retries: int = 3) -> Agent:
+    # Deterministic output, the same email always yields the same events
+    settings = ModelSettings(temperature=0.0)
+    if max_tokens is not None:
+        settings["max_tokens"] = max_tokens
+    match provider, credential:
+        case Provider.OLLAMA, OllamaCredential():
+            logger.debug("Building Ollama model")
+            base_url = f"{'https://' if credential.secure else 'http://'}{credential.host}:{credential.port}/v1"
+            logger.debug("Ollama base URL: %s", base_url)
+            return OpenAIChatModel(
+                model_name=model_name,
+                provider=OllamaProvider(base_url=base_url, http_client=http_client),
+                settings=settings,
+            )
+        case Provider.OPENAI, OpenAICredential():
+            logger.debug("Building OpenAI model")
+            return OpenAIChatModel(
+                model_name=model_name,
+                provider=OpenAIProvider(
+                    api_key=credential.api_key, http_client=http_client
+                ),
+                settings=settings,
+            )
+        case Provider.DOCKER, DockerCredential():
+            logger.debug("Building Docker model")
+            base_url = f"{'https://' if credential.secure else 'http://'}{credential.host}:{credential.port}/engines/v1"
+            logger.debug("Docker base URL: %s", base_url)
+            return OpenAIChatModel(
+                model_name=model_name,
+                provider=OllamaProvider(base_url=base_url, http_client=http_client),
+                settings=settings,
+            )
+        case _:
+            raise ValueError(
+                f"Unsupported provider {provider} with credential {type(credential).__name__}"
+            )
+
+
+def build_agent(model: Model, max_retries: int = 3) -> Agent:
     """
     Build and return an AI agent using the specified model.
+    The agent is meant to be built once and reused, the emails of a run are passed
+    through `AgentDependencies`.
     :param model: The AI model to use for the agent.
+    :param max_retries: The maximum number of retries for the agent.
     :return: An instance of the AI agent.
     """
     logger.debug("Building AI agent")
@@ -242,31 +390,35 @@ def build_agent(model: Model, email: EMail, max_retries: int = 3) -> Agent:
         model,
         deps_type=AgentDependencies,
         output_type=Events,
-        system_prompt=[
-            get_system_prompt(email),
-            f"The output must be in the following JSON schema: {Event.model_json_schema()}",
-        ],
+        system_prompt=SYSTEM_PROMPTS,
         retries=max_retries,
     )
 
     @agent.system_prompt()
     async def get_current_events(ctx: RunContext[AgentDependencies]):
         logger.info("Calling get_current_events system prompt")
-        events = Event.get_all()
+        try:
+            events = get_events_context(list(ctx.deps.emails.values()), ctx.deps.db)
+        finally:
+            ctx.deps.release()
         if events:
-            logger.debug("Current events in database: %s", events)
-            return (
-                f"These events are already in the database. If a new event has a similar summary, use the "
-                f"`get_email_delivery_date` tool to determine which event is the most recent, and use the newer event "
-                f"`summary`, `start`, `end`, `id`, and `email_id` when returning the event.\nCurrent events: {events}"
-            )
+            logger.debug("Current events in database:\n%s", events)
+            return f"Existing events, one `id|start|end|summary` per line:\n{events}"
         logger.debug("No current events in database")
-        return "There are no events currently in the database, so all parsed events are new."
+        return "There are no existing events, all parsed events are new."
 
     @agent.tool()
     async def get_events(ctx: RunContext[AgentDependencies]) -> list[Event] | None:
+        """Get the existing events around the emails being parsed."""
         logger.info("Calling get_events tool")
-        events = Event.get_all()
+        try:
+            events = Event.get_starting_between(
+                *get_events_window(list(ctx.deps.emails.values())),
+                EVENTS_CONTEXT_LIMIT,
+                ctx.deps.db,
+            )
+        finally:
+            ctx.deps.release()
         if events:
             logger.debug("Found events: %s", events)
             return events
@@ -277,12 +429,16 @@ def build_agent(model: Model, email: EMail, max_retries: int = 3) -> Agent:
     async def get_delivery_date_by_event(
         ctx: RunContext[AgentDependencies], event_id: int
     ) -> str | None:
-        logger.info(f"Calling get_delivery_date_by_event tool for event: {event_id}")
-        event = Event.get_by_id(event_id)
-        if not event:
-            logger.debug("No event found with id: %d", event_id)
-            return None
-        email = EMail.get_by_id(event.email_id)
+        """Get the ISO-8601 delivery date of the email an existing event came from."""
+        logger.info("Calling get_delivery_date_by_event tool for event: %d", event_id)
+        try:
+            event = Event.get_by_id(event_id, ctx.deps.db)
+            if not event:
+                logger.debug("No event found with id: %d", event_id)
+                return None
+            email = EMail.get_by_id(event.email_id, ctx.deps.db)
+        finally:
+            ctx.deps.release()
         if email:
             logger.debug("Found email: %s", email)
             return email.delivery_date.isoformat()
@@ -291,40 +447,54 @@ def build_agent(model: Model, email: EMail, max_retries: int = 3) -> Agent:
 
     @agent.tool()
     async def get_current_email_delivery_date(
-        ctx: RunContext[AgentDependencies],
+        ctx: RunContext[AgentDependencies], email_id: int | None = None
     ) -> str:
+        """Get the ISO-8601 delivery date of the labelled email being parsed."""
         logger.info("Calling get_current_email_delivery_date tool")
-        email: EMail = ctx.deps.email
+        email: EMail = ctx.deps.get_email(email_id)
         logger.debug("Current email delivery date: %s", email.delivery_date)
         return email.delivery_date.isoformat()
 
     @agent.tool()
     async def save_event(ctx: RunContext[AgentDependencies], event: Event) -> bool:
-        logger.info(f"Calling save_event tool for event: {event}")
+        """Save an event, returns false if it already exists."""
+        logger.info("Calling save_event tool for event: %s", event)
+        db = ctx.deps.db
         try:
             if event.id == 0:
                 event.id = None
-            event.save()
+            # Commit straight away, the write lock must not be held across the next
+            # model request while other batches are saving their events
+            event.save(db)
+            db.commit()
+            invalidate_events_context()
             return True
         except IntegrityError as e:
-            logger.error(f"IntegrityError while saving event: {e}")
-            if (
-                ctx.deps.email.id != event.email_id
-                and ctx.deps.email.delivery_date
-                > EMail.get_by_id(event.email_id).delivery_date
-            ):
-                existing_event = Event.find_unique_event(
-                    event.start, event.end, event.summary
-                )
-                if existing_event:
+            db.rollback()
+            logger.error("IntegrityError while saving event: %s", e)
+            existing = Event.find_unique_event_with_delivery_date(
+                event.start, event.end, event.summary, db
+            )
+            # End the read so a takeover below starts its own write transaction
+            ctx.deps.release()
+            if existing:
+                existing_event, existing_delivery_date = existing
+                email = ctx.deps.get_email(event.email_id)
+                # The newer email wins, take over the existing event
+                if (
+                    email.id != existing_event.email_id
+                    and email.delivery_date > existing_delivery_date
+                ):
                     event.id = existing_event.id
-                    event.save()
+                    event.save(db)
+                    db.commit()
+                    invalidate_events_context()
                     return True
             return False
 
     """@agent.tool()
     async def merge_event(ctx: RunContext[AgentDependencies], event: Event) -> Event:
-        logger.info(f"Calling merge_event tool for event: {event}")
+        logger.info("Calling merge_event tool for event: %s", event)
         return event"""
 
     return agent
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pathlib import Path
 
 from pydantic import (
@@ -6,7 +7,7 @@ from pydantic import (
     Field,
     ValidationError,
 )
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 from src.model.ai import Provider
 
@@ -18,6 +19,10 @@ class Settings(BaseSettings):
     IMAP_PASSWORD: str = Field(default=None, description="IMAP password")
     IMAP_MAILBOX: str = Field("INBOX", description="IMAP mailbox to check")
     IMAP_SSL: bool = Field(True, description="Whether to use SSL for IMAP connection")
+    IMAP_IDLE: bool = Field(
+        True,
+        description="Whether to wait for new emails with IMAP IDLE between checks instead of only polling",
+    )
 
     FILTER_FROM_EMAIL: EmailStr | None = Field(
         None, description="Email address to filter messages from (optional)"
@@ -47,6 +52,41 @@ class Settings(BaseSettings):
 
     AI_MODEL: str = Field(default=None, description="Model to use for parsing")
     AI_MAX_RETRIES: int = Field(3, ge=0, description="Maximum retries for AI parsing")
+    AI_MAX_TOKENS: int | None = Field(
+        8192,
+        ge=1,
+        description="Maximum number of tokens the AI may generate per request, including reasoning (optional)",
+    )
+    AI_TIMEOUT: int | None = Field(
+        600,
+        ge=1,
+        description="Seconds to wait for the AI to parse an email before giving up (optional)",
+    )
+    # Ollama only serves requests in parallel up to its OLLAMA_NUM_PARALLEL server
+    # setting, and OLLAMA_MAX_LOADED_MODELS must allow AI_MODEL to stay loaded,
+    # otherwise raising this just queues requests on the server instead
+    AI_CONCURRENCY: int = Field(
+        1,
+        ge=1,
+        description="Maximum number of AI requests in flight at the same time, match OLLAMA_NUM_PARALLEL on the Ollama server",
+    )
+    AI_BATCH_SIZE: int = Field(
+        1,
+        ge=1,
+        description="Maximum number of emails parsed in a single AI request",
+    )
+    AI_BATCH_MAX_TOKENS: int = Field(
+        4000,
+        ge=1,
+        description="Approximate token budget for the email bodies of a single AI request",
+    )
+    AI_CACHE: bool = Field(
+        True,
+        description="Whether to reuse the parsed events of previously seen email bodies",
+    )
+    AI_CACHE_TTL_DAYS: int = Field(
+        30, ge=1, description="Number of days parsed events are cached for"
+    )
 
     AI_SYSTEM_PROMPT: str | None = Field(
         None, description="Custom system prompt for the AI model (optional)"
@@ -63,30 +103,35 @@ class Settings(BaseSettings):
         None, description="Apprise notification service URL (optional)"
     )
 
-    class Config:
-        env_file = ".env"
-        env_file_encoding = "utf-8"
-        case_sensitive = True
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        env_file_encoding="utf-8",
+        case_sensitive=True,
+        frozen=True,
+    )
 
 
+# Reading .env and validating every field is only done once per process
+@lru_cache(maxsize=1)
 def get_settings() -> Settings:
     try:
         settings = Settings()
+        overrides = {}
         if settings.AI_PROVIDER == Provider.OLLAMA and not settings.AI_MODEL:
-            settings.AI_MODEL = "gpt-oss:20b"
-            assert settings.OLLAMA_HOST is not None
-            assert settings.OLLAMA_PORT is not None
+            overrides["AI_MODEL"] = "gpt-oss:20b"
+            assert settings.HOST is not None
+            assert settings.PORT is not None
         elif settings.AI_PROVIDER == Provider.OPENAI and not settings.AI_MODEL:
-            settings.AI_MODEL = "gpt-5-mini"
+            overrides["AI_MODEL"] = "gpt-5-mini"
             assert settings.OPEN_AI_API_KEY is not None
 
         if settings.AI_SYSTEM_PROMPT_FILE:
             try:
                 with open(settings.AI_SYSTEM_PROMPT_FILE, "r") as f:
-                    settings.AI_SYSTEM_PROMPT = f.read()
+                    overrides["AI_SYSTEM_PROMPT"] = f.read()
             except Exception as e:  # noqa: BLE001
                 raise ValueError(f"Error reading system prompt file: {e}")
-        return settings
+        return settings.model_copy(update=overrides) if overrides else settings
     except ValidationError as exc:
         # Fail fast with a clear error so startup doesn't proceed with bad config
         raise SystemExit(f"Environment validation error:\n{exc}")
@@ -0,0 +1,38 @@
+import os
+import tempfile
+from datetime import UTC, datetime
+
+# Point the app at a throwaway database before any module reads the settings
+os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(), "emails.db")
+
+# Nothing connects to these in the tests, they only have to pass validation
+for name, value in {
+    "IMAP_HOST": "imap.example.com",
+    "IMAP_USERNAME": "user@example.com",
+    "IMAP_PASSWORD": "password",
+    "CALDAV_URL": "https://caldav.example.com",
+    "CALDAV_USERNAME": "user",
+    "CALDAV_PASSWORD": "password",
+    "CALDAV_CALENDAR": "Calendar",
+    "AI_PROVIDER": "ollama",
+    "AI_MODEL": "gpt-oss:20b",
+}.items():
+    os.environ.setdefault(name, value)
+
+# Imported once the environment is in place, the settings are read on import
+from src.model.email import EMail, EMailType
+
+
+def make_email(
+    email_id: int,
+    body: str | None = "Oct 1 practice",
+    delivery_date: datetime = datetime(2024, 9, 1, tzinfo=UTC),
+) -> EMail:
+    return EMail(
+        id=email_id,
+        subject="Schedule",
+        from_address="coach@example.com",
+        delivery_date=delivery_date,
+        body=body,
+        email_type=EMailType.PLAIN,
+    )
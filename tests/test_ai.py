@@ -0,0 +1,109 @@
+from datetime import UTC, datetime
+from unittest import TestCase
+
+from pydantic_ai import ModelRetry
+
+from src.db import create_db
+from src.model.event import Event
+from src.util.ai import (
+    AgentDependencies,
+    batch_emails,
+    cache_events,
+    evict_cached_events,
+    get_cache_key,
+    get_cached_events,
+    may_contain_events,
+)
+from tests.conftest import make_email
+
+
+class TestBatchEmails(TestCase):
+    def test_max_emails(self):
+        emails = [make_email(i) for i in range(1, 6)]
+        batches = batch_emails(emails, max_emails=2, max_tokens=1000)
+        self.assertEqual([[e.id for e in b] for b in batches], [[1, 2], [3, 4], [5]])
+
+    def test_token_budget(self):
+        emails = [make_email(i, "x" * 400) for i in range(1, 4)]
+        batches = batch_emails(emails, max_emails=10, max_tokens=250)
+        self.assertEqual([[e.id for e in b] for b in batches], [[1, 2], [3]])
+
+    def test_oversized_email_gets_own_batch(self):
+        emails = [make_email(1), make_email(2, "x" * 4000), make_email(3)]
+        batches = batch_emails(emails, max_emails=10, max_tokens=100)
+        self.assertEqual([[e.id for e in b] for b in batches], [[1], [2], [3]])
+
+    def test_empty_body(self):
+        emails = [make_email(1, None), make_email(2, "")]
+        batches = batch_emails(emails, max_emails=10, max_tokens=100)
+        self.assertEqual([[e.id for e in b] for b in batches], [[1, 2]])
+
+
+class TestMayContainEvents(TestCase):
+    def test_month_and_day(self):
+        self.assertTrue(may_contain_events("**October**\n22-23 Tournament"))
+        self.assertTrue(may_contain_events("Practice on Sept 3rd at 5pm"))
+
+    def test_numeric_date(self):
+        self.assertTrue(may_contain_events("Meet 10/22 at the field"))
+        self.assertTrue(may_contain_events("Starts 2024-10-22"))
+
+    def test_no_date(self):
+        self.assertFalse(may_contain_events("Thanks for your order, total 12 items"))
+        self.assertFalse(may_contain_events("Your receipt"))
+
+    def test_month_without_day(self):
+        self.assertFalse(may_contain_events("You may want to bring water"))
+        self.assertFalse(may_contain_events("decoration and marks 5"))
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        create_db()
+
+    def test_key_ignores_quotes_and_whitespace(self):
+        email = make_email(1, "Oct 1  Practice\n> earlier reply")
+        same = make_email(2, "oct 1 practice")
+        self.assertEqual(get_cache_key(email, "model"), get_cache_key(same, "model"))
+        self.assertNotEqual(
+            get_cache_key(email, "model"), get_cache_key(email, "other")
+        )
+
+    def test_round_trip(self):
+        key = get_cache_key(make_email(1, "Nov 2 recital"), "round-trip")
+        self.assertIsNone(get_cached_events(key, 1))
+        start = datetime(2024, 11, 2, 18, tzinfo=UTC)
+        cache_events(key, [Event(start=start, end=start, summary="recital")])
+
+        events = get_cached_events(key, 5)
+
+        self.assertEqual(
+            [(e.start, e.end, e.all_day, e.summary, e.email_id) for e in events],
+            [(start, start, False, "recital", 5)],
+        )
+
+    def test_evicts_expired_entries(self):
+        key = get_cache_key(make_email(1, "Nov 3 recital"), "evict")
+        cache_events(key, [])
+        evict_cached_events(1)
+        self.assertEqual(get_cached_events(key, 1), [])
+        self.assertGreaterEqual(evict_cached_events(0), 1)
+        self.assertIsNone(get_cached_events(key, 1))
+
+
+class TestAgentDependencies(TestCase):
+    def test_single_email_id_optional(self):
+        deps = AgentDependencies(emails={1: make_email(1)}, db=None)
+        self.assertEqual(deps.get_email().id, 1)
+        self.assertEqual(deps.get_email(99).id, 1)
+
+    def test_batch_picks_email(self):
+        deps = AgentDependencies(emails={1: make_email(1), 2: make_email(2)}, db=None)
+        self.assertEqual(deps.get_email(2).id, 2)
+
+    def test_batch_requires_known_id(self):
+        deps = AgentDependencies(emails={1: make_email(1), 2: make_email(2)}, db=None)
+        with self.assertRaises(ModelRetry):
+            deps.get_email()
+        with self.assertRaises(ModelRetry):
+            deps.get_email(3)
@@ -0,0 +1,43 @@
+import threading
+import time
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from src.db import create_db, engine, write_session
+from src.model.ai_cache import AICache
+
+
+class TestWriteSession(TestCase):
+    def setUp(self):
+        create_db()
+
+    def test_read_then_write_waits_for_other_writer(self):
+        locked = threading.Event()
+
+        def hold_write_lock():
+            with write_session() as db:
+                AICache(key="held", events_json="[]").save(db)
+                locked.set()
+                time.sleep(0.2)
+
+        writer = threading.Thread(target=hold_write_lock)
+        writer.start()
+        locked.wait()
+        # Reads before it writes, a deferred transaction would get SQLITE_BUSY here
+        with write_session() as db:
+            held = AICache.get_by_key("held", db)
+            AICache(key="waited", events_json=held.events_json).save(db)
+        writer.join()
+
+        self.assertIsNotNone(AICache.get_by_key("waited"))
+
+
+class TestCreateDb(TestCase):
+    def test_drops_old_response_cache(self):
+        with engine.begin() as conn:
+            conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS ai_cache (key TEXT)")
+        create_db()
+        tables = inspect(engine).get_table_names()
+        self.assertNotIn("ai_cache", tables)
+        self.assertIn("response_cache", tables)
@@ -0,0 +1,18 @@
+from unittest import TestCase
+
+from src.db import create_db
+from src.model.email import EMail
+from tests.conftest import make_email
+
+
+class TestGetExistingIds(TestCase):
+    def setUp(self):
+        create_db()
+
+    def test_returns_only_stored_ids(self):
+        make_email(2101).save()
+        make_email(2102).save()
+        self.assertEqual(EMail.get_existing_ids([2101, 2102, 2103]), {2101, 2102})
+
+    def test_no_ids(self):
+        self.assertEqual(EMail.get_existing_ids([]), set())
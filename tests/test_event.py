@@ -0,0 +1,57 @@
+from datetime import UTC, datetime
+from unittest import TestCase
+
+from src.db import create_db
+from src.model.event import Event
+from tests.conftest import make_email
+
+
+class TestGetByDate(TestCase):
+    def setUp(self):
+        create_db()
+
+    def test_matches_start_or_end(self):
+        make_email(1601, "March 10 practice").save()
+        date = datetime(2023, 3, 10, tzinfo=UTC)
+        other = datetime(2023, 3, 9, tzinfo=UTC)
+        later = datetime(2023, 3, 11, tzinfo=UTC)
+        Event(start=date, end=later, summary="starts on date", email_id=1601).save()
+        Event(start=other, end=date, summary="ends on date", email_id=1601).save()
+        Event(start=other, end=later, summary="spans date", email_id=1601).save()
+
+        events = Event.get_by_date(date)
+
+        self.assertEqual(
+            sorted(event.summary for event in events),
+            ["ends on date", "starts on date"],
+        )
+
+
+class TestSave(TestCase):
+    def setUp(self):
+        create_db()
+
+    def test_upsert_keeps_caldav_id(self):
+        make_email(1501, "May 1 practice").save()
+        start = datetime(2024, 5, 1, 17, tzinfo=UTC)
+        end = datetime(2024, 5, 1, 18, tzinfo=UTC)
+        event = Event(start=start, end=end, summary="Practice", email_id=1501)
+        event = event.save()
+        self.assertIsNotNone(event.id)
+        self.assertEqual(event.summary, "practice")
+        event.caldav_id = "cal-1501"
+        event.save_to_caldav()
+
+        updated = Event(
+            id=event.id,
+            start=start,
+            end=end,
+            summary="Practice moved",
+            email_id=1501,
+            in_calendar=True,
+        ).save()
+
+        self.assertEqual(updated.id, event.id)
+        self.assertEqual(updated.summary, "practice moved")
+        self.assertEqual(updated.caldav_id, "cal-1501")
+        self.assertEqual(Event.get_by_id(event.id).summary, "practice moved")
@@ -0,0 +1,63 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from src.mail.mail import get_emails_by_filter
+from src.util.env import get_settings
+
+
+def make_message(email_id: int) -> bytes:
+    return (
+        f"From: coach@example.com\r\n"
+        f"Subject: Schedule {email_id}\r\n"
+        f"Date: {email_id} Sep 2024 10:00:00 +0000\r\n"
+        f"Content-Type: text/plain\r\n\r\n"
+        f"Oct {email_id} practice\r\n"
+    ).encode()
+
+
+class FakeIMAPClient:
+    def __init__(self, email_ids: list[int], missing_from_batch: set[int]):
+        self.email_ids = email_ids
+        self.missing_from_batch = missing_from_batch
+        self.fetches: list[bytes] = []
+
+    def select(self, mailbox):
+        return "OK", [str(len(self.email_ids)).encode()]
+
+    def search(self, charset, criteria):
+        return "OK", [" ".join(map(str, self.email_ids)).encode()]
+
+    def fetch(self, message_set, spec):
+        self.fetches.append(message_set)
+        data = []
+        for email_id in map(int, message_set.split(b",")):
+            if b"," in message_set and email_id in self.missing_from_batch:
+                continue
+            raw = make_message(email_id)
+            data.append((f"{email_id} (RFC822 {{{len(raw)}}}".encode(), raw))
+            data.append(b")")
+        return "OK", data
+
+
+class TestGetEmailsByFilter(TestCase):
+    def setUp(self):
+        self.settings = get_settings().model_copy(
+            update={"FILTER_FROM_EMAIL": "coach@example.com"}
+        )
+
+    def test_fetches_in_batches(self):
+        client = FakeIMAPClient([1, 2, 3, 4, 5], missing_from_batch=set())
+        with patch("src.mail.mail.FETCH_BATCH_SIZE", 2):
+            emails = get_emails_by_filter(client, self.settings)
+
+        self.assertEqual(client.fetches, [b"5,4", b"3,2", b"1"])
+        self.assertEqual([e.id for e in emails], [1, 2, 3, 4, 5])
+        self.assertEqual(emails[2].subject, "Schedule 3")
+        self.assertEqual(emails[2].body.strip(), "Oct 3 practice")
+
+    def test_fetches_missing_email_alone(self):
+        client = FakeIMAPClient([1, 2, 3], missing_from_batch={2})
+        emails = get_emails_by_filter(client, self.settings)
+
+        self.assertEqual(client.fetches, [b"3,2,1", b"2"])
+        self.assertEqual([e.id for e in emails], [1, 2, 3])
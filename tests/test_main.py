@@ -0,0 +1,213 @@
+import asyncio
+import json
+import threading
+from datetime import UTC, datetime
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
+
+from pydantic_ai.models.function import AgentInfo, DeltaToolCall, FunctionModel
+
+from src.db import SessionLocal, create_db
+from src.main import _normalize_event, generate_events_from_emails, save_events
+from src.model.event import Event
+from src.util.ai import build_agent
+from src.util.env import get_settings
+from tests.conftest import make_email
+
+
+def make_output(email_ids: list[int]) -> str:
+    return json.dumps(
+        {
+            "events": [
+                {
+                    "start": f"2024-10-{index + 1:02d}T17:00:00",
+                    "end": f"2024-10-{index + 1:02d}T18:00:00",
+                    "summary": f"event {index}",
+                    "email_id": email_id,
+                }
+                for index, email_id in enumerate(email_ids)
+            ]
+        }
+    )
+
+
+class TestNormalizeEvent(TestCase):
+    def test_single_email_owns_events(self):
+        event = Event(
+            start="2024-10-01T17:00:00",
+            end="2024-10-01T18:00:00",
+            summary="practice",
+            email_id=99,
+        )
+        event = _normalize_event(event, {1: make_email(1)})
+        self.assertEqual(event.email_id, 1)
+        self.assertEqual(event.start, datetime(2024, 10, 1, 17))
+        self.assertEqual(event.end, datetime(2024, 10, 1, 18))
+
+    def test_batch_keeps_labelled_email(self):
+        event = Event(
+            start=datetime(2024, 10, 1),
+            end=datetime(2024, 10, 1),
+            summary="practice",
+            email_id=2,
+        )
+        emails = {1: make_email(1), 2: make_email(2)}
+        self.assertEqual(_normalize_event(event, emails).email_id, 2)
+
+    def test_batch_drops_unknown_email(self):
+        event = Event(
+            start=datetime(2024, 10, 1),
+            end=datetime(2024, 10, 1),
+            summary="practice",
+            email_id=3,
+        )
+        emails = {1: make_email(1), 2: make_email(2)}
+        self.assertIsNone(_normalize_event(event, emails))
+
+
+class TestGenerateEventsFromEmails(IsolatedAsyncioTestCase):
+    def setUp(self):
+        create_db()
+        self.settings = get_settings().model_copy(
+            update={"AI_CACHE": False, "AI_TIMEOUT": 10}
+        )
+
+    async def generate(self, emails, stream_function):
+        agent = build_agent(FunctionModel(stream_function=stream_function), 0)
+        return [
+            (email_id, [event.summary for event in events])
+            async for email_id, events in generate_events_from_emails(
+                emails, self.settings, agent
+            )
+        ]
+
+    async def test_splits_events_by_email(self):
+        emails = [make_email(1), make_email(2), make_email(3, "Your receipt")]
+        output = make_output([1, 1, 2])
+
+        async def stream_function(messages, info: AgentInfo):
+            yield {0: DeltaToolCall(name=info.output_tools[0].name, json_args="")}
+            for index in range(0, len(output), 16):
+                yield {0: DeltaToolCall(json_args=output[index : index + 16])}
+
+        self.assertEqual(
+            await self.generate(emails, stream_function),
+            [(3, []), (1, ["event 0", "event 1"]), (2, ["event 2"])],
+        )
+
+    async def test_yields_complete_emails_while_streaming(self):
+        emails = [make_email(1), make_email(2), make_email(3)]
+        output = make_output([1, 2, 3, 3])
+        # Hold the rest of the output back until the first email has been yielded
+        split = output.index('{"start"', output.index('"email_id": 3')) - 1
+        first_yielded = asyncio.Event()
+
+        async def stream_function(messages, info: AgentInfo):
+            yield {0: DeltaToolCall(name=info.output_tools[0].name, json_args="")}
+            yield {0: DeltaToolCall(json_args=output[:split])}
+            await asyncio.wait_for(first_yielded.wait(), timeout=5)
+            yield {0: DeltaToolCall(json_args=output[split:])}
+
+        agent = build_agent(FunctionModel(stream_function=stream_function), 0)
+        yielded = []
+        async for email_id, events in generate_events_from_emails(
+            emails, self.settings, agent
+        ):
+            yielded.append((email_id, [event.summary for event in events]))
+            first_yielded.set()
+        self.assertEqual(
+            yielded,
+            [
+                (1, ["event 0"]),
+                (2, ["event 1"]),
+                (3, ["event 2", "event 3"]),
+            ],
+        )
+
+    async def test_late_events_are_merged(self):
+        emails = [make_email(1), make_email(2), make_email(3)]
+        output = make_output([1, 2, 1, 1, 3])
+
+        async def stream_function(messages, info: AgentInfo):
+            yield {0: DeltaToolCall(name=info.output_tools[0].name, json_args="")}
+            for index in range(0, len(output), 16):
+                yield {0: DeltaToolCall(json_args=output[index : index + 16])}
+
+        self.assertEqual(
+            await self.generate(emails, stream_function),
+            [
+                (1, ["event 0"]),
+                (2, ["event 1"]),
+                (3, ["event 4"]),
+                (1, ["event 2", "event 3"]),
+            ],
+        )
+
+
+class TestSaveEvents(IsolatedAsyncioTestCase):
+    def setUp(self):
+        create_db()
+        self.settings = get_settings()
+
+    async def test_pushes_committed_events_from_a_thread(self):
+        email = make_email(2201, "Oct 5 game")
+        date = datetime(2024, 10, 5, tzinfo=UTC)
+        pushed = []
+
+        def push_to_caldav(url, username, password, calendar_name, events):
+            # The rows are committed before the CalDAV requests start
+            with SessionLocal() as db:
+                committed = Event.get_by_id(events[0].id, db)
+            pushed.append((threading.current_thread(), committed is not None))
+            for event in events:
+                event.caldav_id = f"cal-{event.id}"
+                event.in_calendar = True
+
+        with SessionLocal() as session:
+            email.save(session)
+            session.commit()
+            with (
+                patch("src.main.push_to_caldav", push_to_caldav),
+                patch("src.main.send_success_notification"),
+            ):
+                await save_events(
+                    email,
+                    [Event(start=date, end=date, summary="game")],
+                    self.settings,
+                    session,
+                )
+
+        self.assertEqual(len(pushed), 1)
+        self.assertIsNot(pushed[0][0], threading.main_thread())
+        self.assertTrue(pushed[0][1])
+        saved = Event.find_unique_event(date, date, "game")
+        self.assertTrue(saved.in_calendar)
+        self.assertEqual(saved.caldav_id, f"cal-{saved.id}")
+
+    async def test_pushes_events_saved_by_the_agent(self):
+        email = make_email(1901, "Oct 6 game")
+        date = datetime(2024, 10, 6, tzinfo=UTC)
+        email.save()
+        # Stored through the save_event tool while the model was running
+        Event(start=date, end=date, summary="game", email_id=email.id).save()
+        pushed = []
+
+        def push_to_caldav(url, username, password, calendar_name, events):
+            pushed.extend(event.summary for event in events)
+            for event in events:
+                event.in_calendar = True
+
+        with (
+            SessionLocal() as session,
+            patch("src.main.push_to_caldav", push_to_caldav),
+            patch("src.main.send_success_notification"),
+        ):
+            await save_events(
+                email,
+                [Event(start=date, end=date, summary="Game")],
+                self.settings,
+                session,
+            )
+
+        self.assertEqual(pushed, ["game"])
+        self.assertTrue(Event.find_unique_event(date, date, "game").in_calendar)